@@ -0,0 +1,249 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+bench/sftp.py
+Rainwatch > SFTP write throughput benchmark
+
+Sends a file to a local Paramiko SFTP server, once with Paramiko's SFTPClient.put()
+and once with rainshell's write engine, and reports the throughput of each. The
+server runs in this process, and a relay can add latency to the connection to
+show the effect of pipelining. Exits with a non-zero status if a copy differs
+
+Usage: python3 bench/sftp.py [-s SIZE] [-n RUNS] [-l MS]
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import os
+import sys
+import time
+import queue
+import shutil
+import socket
+import hashlib
+import optparse
+import tempfile
+import threading
+import subprocess
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from rwatch import ssh2, jabber
+from rwatch.logthis import loglevel, LL
+
+
+class BenchHandle(paramiko.SFTPHandle):
+    """
+    handle for a local file opened by the server
+    """
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class BenchSFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP server backed by the local filesystem, with just enough operations for put()
+    """
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            fobj = os.fdopen(fd, 'r+b')
+        else:
+            fobj = os.fdopen(fd, 'rb')
+        th = BenchHandle(flags)
+        th.filename = path
+        th.readfile = fobj
+        th.writefile = fobj
+        return th
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def canonicalize(self, path):
+        return os.path.realpath(path)
+
+
+class BenchServer(paramiko.ServerInterface):
+    """
+    accepts any login, and runs exec requests (used for `df`) with the local shell
+    """
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def _run():
+            pout = subprocess.run(command.decode(), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            channel.sendall(pout.stdout)
+            channel.sendall_stderr(pout.stderr)
+            channel.send_exit_status(pout.returncode)
+            channel.close()
+        threading.Thread(target=_run, daemon=True).start()
+        return True
+
+
+def serve():
+    """
+    start the SFTP server on a free local port; returns the port number
+    """
+    hostkey = paramiko.RSAKey.generate(2048)
+    lsock = socket.socket()
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(5)
+
+    def _accept():
+        while True:
+            csock, addr = lsock.accept()
+            ttran = paramiko.Transport(csock)
+            ttran.add_server_key(hostkey)
+            ttran.set_subsystem_handler('sftp', paramiko.SFTPServer, BenchSFTP)
+            ttran.start_server(server=BenchServer())
+
+    threading.Thread(target=_accept, daemon=True).start()
+    return lsock.getsockname()[1]
+
+
+def relay(port, delay):
+    """
+    start a relay to `port` that delays data by `delay` seconds in each direction;
+    returns the relay's port number
+    """
+    lsock = socket.socket()
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(5)
+
+    def _pipe(src, dst):
+        tq = queue.Queue()
+        def _send():
+            while True:
+                tdue, data = tq.get()
+                time.sleep(max(0, tdue - time.time()))
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+        threading.Thread(target=_send, daemon=True).start()
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b''
+            tq.put((time.time() + delay, data))
+            if not data:
+                return
+
+    def _accept():
+        while True:
+            csock, addr = lsock.accept()
+            ssock = socket.create_connection(('127.0.0.1', port))
+            threading.Thread(target=_pipe, args=(csock, ssock), daemon=True).start()
+            threading.Thread(target=_pipe, args=(ssock, csock), daemon=True).start()
+
+    threading.Thread(target=_accept, daemon=True).start()
+    return lsock.getsockname()[1]
+
+
+def md5file(path):
+    """
+    returns the MD5 hex digest of a local file
+    """
+    thash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for tblk in iter(lambda: f.read(1048576), b''):
+            thash.update(tblk)
+    return thash.hexdigest()
+
+
+def run_put(port, src, dest):
+    """
+    copy `src` with SFTPClient.put()
+    """
+    rsh = ssh2.rainshell('127.0.0.1', username='bench', password='bench', port=port)
+    sftp = rsh.open_sftp()
+    tstart = time.perf_counter()
+    sftp.put(src, dest + '/' + os.path.basename(src))
+    tdelta = time.perf_counter() - tstart
+    rsh.close()
+    return tdelta
+
+
+def run_engine(port, src, dest):
+    """
+    copy `src` with rainshell.xfer()
+    """
+    rsh = ssh2.rainshell('127.0.0.1', username='bench', password='bench', port=port)
+    rsh.resume = False
+    tstart = time.perf_counter()
+    rsh.xfer(src, dest)
+    tdelta = time.perf_counter() - tstart
+    rsh.close()
+    return tdelta
+
+
+def main():
+    oparser = optparse.OptionParser(usage="%prog [options]")
+    oparser.add_option('-s', action="store", dest="size", type="int", default=256, metavar="MB", help="Size of the test file, in MiB (default: 256)")
+    oparser.add_option('-n', action="store", dest="runs", type="int", default=3, metavar="RUNS", help="Samples per method (default: 3)")
+    oparser.add_option('-l', action="store", dest="latency", type="float", default=0, metavar="MS", help="Latency added in each direction, in milliseconds (default: 0)")
+    opts, args = oparser.parse_args()
+
+    # keep the transfers quiet, and don't try to send Jabber status updates
+    loglevel(LL.ERROR)
+    jabber.send = lambda *args, **kwargs: None
+
+    tdir = tempfile.mkdtemp(prefix="rwbench.")
+    try:
+        src = os.path.join(tdir, 'src.bin')
+        with open(src, 'wb') as f:
+            for i in range(opts.size):
+                f.write(os.urandom(1048576))
+        srchash = md5file(src)
+
+        port = serve()
+        if opts.latency > 0:
+            port = relay(port, opts.latency / 1000.0)
+
+        failed = False
+        for tname, tfunc in (('put', run_put), ('engine', run_engine)):
+            samples = []
+            for i in range(max(1, opts.runs)):
+                dest = os.path.join(tdir, 'dest')
+                shutil.rmtree(dest, ignore_errors=True)
+                os.mkdir(dest)
+                samples.append(tfunc(port, src, dest))
+                if md5file(os.path.join(dest, 'src.bin')) != srchash:
+                    failed = True
+            samples.sort()
+            median = samples[len(samples) // 2]
+            print("%-6s median %7.2f s  %8.1f MiB/s  (min %.2f s, max %.2f s)%s" %
+                  (tname, median, opts.size / median, samples[0], samples[-1], "  COPY DIFFERS" if failed else ""))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
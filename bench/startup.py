@@ -0,0 +1,95 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+bench/startup.py
+Rainwatch > CLI startup-time benchmark
+
+Measures the cold import time of the hook and list modes, each in a fresh
+interpreter, and checks that they don't load any of the daemon's heavy
+dependencies. Exits with a non-zero status if a mode is over its budget
+
+Usage: python3 bench/startup.py [-n RUNS] [--hook-budget MS] [--list-budget MS]
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import os
+import sys
+import json
+import optparse
+import subprocess
+
+# mode -> (modules imported by the mode, default budget in milliseconds)
+MODES = {
+            'hook': (['rwatch.hook'], 75),
+            'list': (['rwatch.cli', 'rwatch.rcfile', 'rwatch.tclient', 'rwatch.tclient.deluge'], 150)
+        }
+
+# Top-level packages that only the daemon should load
+HEAVY = [ 'flask', 'paramiko', 'sleekxmpp', 'PIL', 'zmq', 'pymongo', 'redis', 'requests', 'arrow', 'setproctitle' ]
+
+# Run in a fresh interpreter for each sample; prints the import time and any heavy modules loaded
+PROBE = """
+import sys, time, json, importlib
+t0 = time.perf_counter()
+for m in %r:
+    importlib.import_module(m)
+t1 = time.perf_counter()
+print(json.dumps({ 'ms': (t1 - t0) * 1000.0, 'heavy': sorted(set(x.split('.')[0] for x in sys.modules) & set(%r)) }))
+"""
+
+
+def probe(mods):
+    """
+    import `mods` in a fresh interpreter; returns (milliseconds, heavy modules loaded)
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ x for x in [ os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                     env.get('PYTHONPATH') ] if x ])
+    pout = subprocess.check_output([ sys.executable, '-c', PROBE % (mods, HEAVY) ], env=env)
+    res = json.loads(pout.decode('utf-8').strip().splitlines()[-1])
+    return res['ms'], res['heavy']
+
+
+def main():
+    oparser = optparse.OptionParser(usage="%prog [options]")
+    oparser.add_option('-n', action="store", dest="runs", type="int", default=10, metavar="RUNS", help="Samples per mode (default: 10)")
+    for tmode, (tmods, tbudget) in MODES.items():
+        oparser.add_option('--%s-budget' % (tmode), action="store", dest="%s_budget" % (tmode), type="float", default=tbudget,
+                           metavar="MS", help="Import-time budget for %s mode, in milliseconds (default: %d)" % (tmode, tbudget))
+    opts, args = oparser.parse_args()
+
+    failed = False
+    for tmode, (tmods, tbudget) in sorted(MODES.items()):
+        tbudget = getattr(opts, "%s_budget" % (tmode))
+        samples = []
+        heavy = set()
+        for i in range(max(1, opts.runs)):
+            tms, theavy = probe(tmods)
+            samples.append(tms)
+            heavy.update(theavy)
+        samples.sort()
+        median = samples[len(samples) // 2]
+
+        status = "ok"
+        if median > tbudget:
+            status = "OVER BUDGET"
+            failed = True
+        if heavy:
+            status = "LOADS %s" % (', '.join(sorted(heavy)))
+            failed = True
+        print("%-5s median %7.1f ms  min %7.1f ms  max %7.1f ms  budget %6.1f ms  %s" %
+              (tmode, median, samples[0], samples[-1], tbudget, status))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,15 +15,15 @@ https://ycnrg.org/
 
 """
 
-from rwatch.util import XConfig, git_info_raw
 from rwatch.logthis import *
 
 __version__ = "0.12.4"
 __date__ = "15 Jan 2017"
 
-__all__ = ['gitinfo', 'defaults', '__version__', '__date__']
+__all__ = ['defaults', 'rcfiles', '__version__', '__date__']
 
-gitinfo = git_info_raw()
+# RCfile list
+rcfiles = [ './rainwatch.conf', '~/.rainwatch/rainwatch.conf', '~/.rainwatch', '/etc/rainwatch.conf' ]
 
 defaults = {
             'run': {
@@ -42,14 +42,56 @@ defaults = {
                 'logfile_level': LL.VERBOSE,
                 'logfile': "rainwatch.log",
                 'rules': "rainwatch.rules",
-                'tclient': "deluge"
+                'tclient': "deluge",
+                'spool': "~/.rainwatch/spool",
+                'spool_interval': 1.0,
+                'spool_fsync': 0,
+                'reconcile_interval': 300
             },
             'xfer': {
                 'hostname': None,
                 'user': None,
                 'port': 22,
                 'basepath': '',
-                'keyfile': None
+                'keyfile': None,
+                'bwlimit': '0',
+                'bwlimit_schedule': '',
+                'bwlimit_burst': 1.0,
+                'streams': 1,
+                'split_size': '0',
+                'split_streams': 4,
+                'resume': 1,
+                'resume_check': '1M',
+                'manifest_dir': "~/.rainwatch/manifests",
+                'mode': "auto",
+                'tar_threshold': '1M'
+            },
+            'queue': {
+                'workers': 1,
+                'workers_max': 0,
+                'move_workers': 1,
+                'verify_workers': 1,
+                'notify_workers': 1,
+                'move_timeout': 300,
+                'scale_interval': 10,
+                'scale_cooldown': 120,
+                'scale_bytes': 0,
+                'link_capacity': 0,
+                'link_target': 0.9,
+                'backend': "list",
+                'group': "rainwatch",
+                'consumer': None,
+                'lease_ttl': 60,
+                'scheduler': "fifo",
+                'sjf_rate': 10485760,
+                'max_penalty': 3600,
+                'priority_step': 600,
+                'preempt_priority': 0,
+                'max_attempts': 5,
+                'retry_delay': 30,
+                'retry_max_delay': 3600,
+                'dedupe_ttl': 86400,
+                'job_ttl': 604800
             },
             'notify': {
                 'hostname': None,
@@ -63,7 +105,16 @@ defaults = {
                 'port': 4464,
                 'nofork': False,
                 'debug': False,
-                'shared_key': ''
+                'shared_key': '',
+                'socket': "~/.rainwatch/rainwatch.sock",
+                'restart_delay': 1,
+                'restart_max_delay': 60
+            },
+            'cluster': {
+                'enabled': 0,
+                'node': None,
+                'heartbeat': 5,
+                'node_ttl': 15
             },
             'redis': {
                 'host': "localhost",
@@ -83,7 +134,8 @@ defaults = {
                 'user': "",
                 'pass': "",
                 'hostname': "localhost",
-                'port': 58846
+                'port': 58846,
+                'events': 1
             },
             'rtorrent': {
                 'uri': "http://localhost:5000"
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.bwlimit
+Rainwatch > Transfer bandwidth limiting
+
+Cluster-wide token bucket stored in Redis, shared by all transfer workers,
+with time-of-day schedules and optional per-job caps
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import re
+import time
+
+from rwatch.logthis import *
+
+
+# Shared bucket state (hash of tokens, last refill time)
+BUCKET_KEY = "bwlimit:bucket"
+
+# The shared bucket is consulted once this many bytes have been sent, or this
+# many seconds have elapsed, rather than for every chunk written
+BATCH_BYTES = 262144
+BATCH_TIME = 0.25
+
+# KEYS: bucket hash; ARGV: rate (bytes/sec), burst (bytes), bytes sent
+# Refills the bucket, then takes the sent bytes from it. The bucket may go into debt;
+# returns the number of seconds the caller should wait for it to be repaid.
+# Redis server time is used, so that hosts with skewed clocks share the bucket fairly
+LUA_TAKE = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + (tonumber(t[2]) / 1000000)
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (math.max(0, now - ts) * rate)) - tonumber(ARGV[3])
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+if tokens >= 0 then return '0' end
+return tostring(-tokens / rate)
+"""
+
+
+def register_scripts(xredis):
+    """
+    register server-side scripts used for bandwidth limiting
+    """
+    xredis.register_script('bwlimit_take', LUA_TAKE)
+
+
+def parse_rate(rstr):
+    """
+    parse a rate in bytes per second, with an optional K, M or G suffix (powers of 1024);
+    returns 0 (unlimited) for empty values
+    """
+    if not rstr:
+        return 0
+    rmatch = re.match(r'^\s*([0-9.]+)\s*([kmg]?)\s*$', str(rstr), re.I)
+    if not rmatch:
+        raise ValueError("Invalid rate: %s" % (rstr))
+    return int(float(rmatch.group(1)) * (1024 ** ('_kmg'.index(rmatch.group(2).lower() or '_'))))
+
+
+def parse_schedule(sstr):
+    """
+    parse a schedule of the form "HH:MM-HH:MM=RATE, ..."; returns a list of
+    (start minute, end minute, rate) tuples. Ranges may wrap past midnight
+    """
+    sched = []
+    for tent in [ x.strip() for x in (sstr or '').split(',') if x.strip() ]:
+        smatch = re.match(r'^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)$', tent)
+        if not smatch:
+            raise ValueError("Invalid schedule entry: %s" % (tent))
+        sh, sm, eh, em = [ int(x) for x in smatch.groups()[:4] ]
+        sched.append(((sh * 60) + sm, (eh * 60) + em, parse_rate(smatch.group(5))))
+    return sched
+
+
+def current_limit(xconfig, now=None):
+    """
+    returns the cluster-wide rate limit in effect at local time `now`, in bytes per
+    second; the first matching `bwlimit_schedule` entry is used, otherwise `bwlimit`
+    """
+    tnow = time.localtime(now)
+    tmin = (tnow.tm_hour * 60) + tnow.tm_min
+    for sstart, send, srate in parse_schedule(xconfig.xfer['bwlimit_schedule']):
+        if sstart <= send:
+            if sstart <= tmin < send: return srate
+        elif tmin >= sstart or tmin < send:
+            return srate
+    return parse_rate(xconfig.xfer['bwlimit'])
+
+
+class Throttle(object):
+    """
+    byte budget for a single transfer; consume() blocks until the bytes sent
+    fit within both the shared bucket and the per-job cap
+    """
+    def __init__(self, xredis, xconfig, joblimit=None):
+        self.rdx = xredis
+        self.conf = xconfig
+        self.joblimit = parse_rate(joblimit)
+        self.jtokens = self.joblimit
+        self.jts = time.time()
+        self.pending = 0
+        self.lastcheck = time.time()
+        self.failed = False
+
+    def consume(self, nbytes):
+        """
+        account for `nbytes` sent, sleeping as needed
+        """
+        # per-job cap; a local bucket holding up to one second of data
+        if self.joblimit > 0:
+            tnow = time.time()
+            self.jtokens = min(self.joblimit, self.jtokens + ((tnow - self.jts) * self.joblimit)) - nbytes
+            self.jts = tnow
+            if self.jtokens < 0:
+                time.sleep(-self.jtokens / self.joblimit)
+
+        # shared bucket; batched to limit round trips to Redis
+        self.pending += nbytes
+        if self.pending < BATCH_BYTES and (time.time() - self.lastcheck) < BATCH_TIME:
+            return
+
+        try:
+            trate = current_limit(self.conf)
+            if trate > 0:
+                tburst = max(BATCH_BYTES, int(trate * float(self.conf.xfer['bwlimit_burst'])))
+                twait = float(self.rdx.runscript('bwlimit_take', keys=[BUCKET_KEY], args=[trate, tburst, self.pending]))
+                if twait > 0:
+                    time.sleep(twait)
+            self.failed = False
+        except Exception as e:
+            # don't fail the transfer if the bucket can't be reached; carry on unthrottled
+            if not self.failed:
+                logexc(e, "!! Failed to check shared bandwidth limit; continuing without it")
+            self.failed = True
+
+        self.pending = 0
+        self.lastcheck = time.time()
@@ -18,14 +18,14 @@ import sys
 import os
 import json
 import optparse
-import time
-
-import requests
 
 from rwatch import *
 from rwatch.util import *
 from rwatch.logthis import *
-from rwatch import rcfile, ruleparser, daemon, tclient
+from rwatch import rcfile
+
+# Other modules are imported by the mode that needs them, so that the hook and
+# list modes don't load Flask, the Jabber client, Paramiko, etc.
 
 config = None
 
@@ -104,45 +104,41 @@ def mode_list():
     return 0
 
 def mode_chook(tid):
-    global dlx, jbx
+    from rwatch import spool
 
-    # get torrent data
+    # append to the local spool, which the daemon drains into the queue;
+    # rule matching and moving are done by the 'move' pipeline stage
     logthis(">> Processing 'complete' exec hook for", suffix=tid, loglevel=LL.INFO)
-    tordata = dlx.getTorrent(tid)
-
-    # find matching rules
-    rname, rset = ruleparser.match(tordata)
-    if rname:
-        logthis("++ Matched ruleset:\n", suffix=print_r(rset), loglevel=LL.VERBOSE)
-    else:
-        logthis("!! No ruleset matched", loglevel=LL.WARNING)
+    try:
+        spool.append(config, tid)
+        logthis(">> Spooled torrent for transfer", loglevel=LL.INFO)
+        rval = 0
+    except Exception as e:
+        logexc(e, "!! Failed to write to spool; submitting to daemon instead")
+        rval = chook_submit(tid)
 
-    # move to destination dir
-    if rset.get('moveto', None):
-        if dlx.moveTorrent(tid, rset['moveto']):
-            logthis("** Moved to", suffix=rset['moveto'], loglevel=LL.INFO)
-            time.sleep(2)
-        else:
-            logthis("!! Failed to move to", suffix=rset['moveto'], loglevel=LL.ERROR)
+    logthis("*** Finished with complete exec hook for", suffix=tid, loglevel=LL.INFO)
+    return rval
 
-    # enqueue
+def chook_submit(tid):
+    """
+    submit a completion to the daemon's API, for when the spool can't be written
+    """
+    import requests
     qurl = config.srv['url'] + '/api/chook'
     headset = { 'Content-Type': "application/json", 'WWW-Authenticate': config.srv['shared_key'], 'User-Agent': "rainwatch/" + __version__ }
     rq = requests.post(qurl, headers=headset, data=json.dumps({ 'thash': tid, 'opts': False }))
 
     if rq.status_code == 201:
         logthis(">> Queued torrent for transfer", loglevel=LL.INFO)
-        rval = 0
+        return 0
     else:
         logthis("!! Failed to queue for transfer:", suffix=str(rq.status_code)+' '+rq.reason, loglevel=LL.ERROR)
-        rval = 101
-
-    logthis("*** Finished with complete exec hook for", suffix=tordata['name'], loglevel=LL.INFO)
-    return rval
+        return 101
 
 
 def mode_move(tid, destdir):
-    global dlx, jbx
+    global dlx
 
     # get torrent data
     logthis(">> Retrieving torrent data for", suffix=tid, loglevel=LL.INFO)
@@ -187,11 +183,9 @@ def _main():
     else:
         sys.excepthook = exceptionHandler
 
-    # parse rules file
-    ruleparser.parse(config)
-
-    # connect to deluge (for non-daemon stuffs)
-    if not config.run['srv']:
+    # connect to deluge (for the list and move commands)
+    if config.run['list'] or config.run['move'] is not None:
+        from rwatch import tclient
         dlx = tclient.TorrentClient(config)
 
     ## process commands
@@ -206,7 +200,9 @@ def _main():
         # process 'complete' hook
         rval = mode_chook(config.run['torid'])
     elif config.run['srv']:
-        # start daemon
+        # parse rules file, and start daemon
+        from rwatch import ruleparser, daemon
+        ruleparser.parse(config)
         rval = daemon.start(config)
     else:
         logthis("Nothing to do.", loglevel=LL.WARNING)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.cluster
+Rainwatch > Cluster mode
+
+Several rainwatch nodes can share one Redis server. Each node registers itself
+with a heartbeat and drains its own (node-scoped) queues, while an elected
+leader runs cluster-wide tasks such as retry promotion and reaping
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import os
+import time
+import json
+import socket
+import threading
+
+from rwatch.logthis import *
+from rwatch import db
+
+
+# Leader lock, node registry (zset of node name -> last heartbeat) and per-node status hashes
+LEADER_KEY = "cluster:leader"
+NODES_KEY = "cluster:nodes"
+NODE_KEY = "cluster:node:%s"
+
+# KEYS: leader lock; ARGV: node name, TTL
+# Renews the leader lock, but only if it is still held by this node
+LUA_RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Heartbeat start time
+started = None
+
+
+def enabled(xconfig):
+    """
+    returns True if cluster mode is enabled
+    """
+    return bool(int(xconfig.cluster['enabled']))
+
+
+def node_name(xconfig):
+    """
+    returns the name of this node; defaults to the local hostname
+    """
+    return xconfig.cluster['node'] or socket.gethostname()
+
+
+def register_scripts(xredis):
+    """
+    register server-side scripts used for leader election
+    """
+    xredis.register_script('cluster_renew', LUA_RENEW)
+
+
+def start(xconfig, loadfunc=None, idlefunc=None):
+    """
+    start the heartbeat thread; must be called in the master process.
+    `loadfunc(xredis)` should return a dict describing the load on this node, and
+    `idlefunc(xredis, node)` should return True if node `node` has no jobs left in its queues
+    """
+    global started
+    started = time.time()
+
+    hbthread = threading.Thread(target=heartbeat, args=(xconfig, loadfunc, idlefunc), name="cluster", daemon=True)
+    hbthread.start()
+    logthis("Joined cluster as node:", suffix=node_name(xconfig), loglevel=LL.INFO)
+
+
+def heartbeat(xconfig, loadfunc=None, idlefunc=None):
+    """
+    heartbeat thread; registers this node, publishes its load, and takes part in leader election.
+    The leader also removes nodes that have gone away from the registry
+    """
+    xredis = db.redis({ 'host': xconfig.redis['host'], 'port': xconfig.redis['port'], 'db': xconfig.redis['db'] },
+                      prefix=xconfig.redis['prefix'])
+    register_scripts(xredis)
+
+    leader = False
+    while True:
+        try:
+            register(xredis, xconfig, loadfunc(xredis) if loadfunc else {})
+            isleader = elect(xredis, xconfig)
+            if isleader != leader:
+                if isleader:
+                    logthis("** This node is now the cluster leader", loglevel=LL.INFO)
+                else:
+                    logthis("** This node is no longer the cluster leader", loglevel=LL.WARNING)
+                leader = isleader
+            if leader and idlefunc:
+                for tnode in forget(xredis, idlefunc):
+                    logthis("Removed node from cluster:", suffix=tnode, loglevel=LL.INFO)
+        except Exception as e:
+            logexc(e, "!! Cluster heartbeat failed")
+        time.sleep(float(xconfig.cluster['heartbeat']))
+
+
+def register(xredis, xconfig, load):
+    """
+    publish this node's status; the status hash expires after `node_ttl` seconds
+    unless it is refreshed by the next heartbeat
+    """
+    global started
+    tnode = node_name(xconfig)
+    xredis.hset(NODE_KEY % (tnode), { 'node': tnode, 'host': socket.gethostname(), 'pid': os.getpid(),
+                                      'started': started or time.time(), 'heartbeat': time.time(),
+                                      'loadavg': os.getloadavg()[0], 'load': json.dumps(load) })
+    xredis.expire(NODE_KEY % (tnode), int(xconfig.cluster['node_ttl']))
+    xredis.zadd(NODES_KEY, tnode, time.time())
+
+
+def elect(xredis, xconfig):
+    """
+    take or renew the leader lock; returns True if this node is the leader. If the
+    leader stops sending heartbeats, its lock expires after `node_ttl` seconds, and
+    the next node to try takes over
+    """
+    tnode = node_name(xconfig)
+    if xredis.set(LEADER_KEY, tnode, nx=True, ex=int(xconfig.cluster['node_ttl'])):
+        return True
+    return bool(xredis.runscript('cluster_renew', keys=[LEADER_KEY], args=[tnode, int(xconfig.cluster['node_ttl'])]))
+
+
+def is_leader(xredis, xconfig):
+    """
+    returns True if this node is the leader; always True outside of cluster mode
+    """
+    if not enabled(xconfig):
+        return True
+    return xredis.get(LEADER_KEY) == node_name(xconfig)
+
+
+def members(xredis):
+    """
+    returns the names of all registered nodes, including nodes that are
+    currently down but still have jobs in their queues
+    """
+    return xredis.zrange(NODES_KEY, 0, -1)
+
+
+def forget(xredis, idlefunc):
+    """
+    remove nodes whose status hash has expired from the registry, once `idlefunc(xredis, node)`
+    reports that their queues are empty; until then, the leader keeps reaping and promoting
+    jobs for them. A node that comes back re-registers with its next heartbeat.
+    Returns the names of the nodes that were removed
+    """
+    removed = []
+    for tnode in members(xredis):
+        if xredis.exists(NODE_KEY % (tnode)) or not idlefunc(xredis, tnode):
+            continue
+        if xredis.zrem(NODES_KEY, tnode):
+            removed.append(tnode)
+    return removed
+
+
+def report(xredis, xconfig):
+    """
+    returns the leader, and the status and load of each node
+    """
+    if not enabled(xconfig):
+        return { 'enabled': False, 'node': node_name(xconfig), 'leader': None, 'nodes': {} }
+
+    nlist = members(xredis)
+    nodes = {}
+    for tnode, traw in zip(nlist, xredis.hgetall_multi([ NODE_KEY % (x) for x in nlist ])):
+        if traw:
+            tinfo = dict(traw)
+            for tk in ('started', 'heartbeat', 'loadavg'):
+                tinfo[tk] = float(tinfo[tk])
+            tinfo['pid'] = int(tinfo['pid'])
+            tinfo['load'] = json.loads(tinfo.get('load') or '{}')
+            tinfo['alive'] = True
+        else:
+            tinfo = { 'node': tnode, 'alive': False }
+        nodes[tnode] = tinfo
+
+    return { 'enabled': True, 'node': node_name(xconfig), 'leader': xredis.get(LEADER_KEY), 'nodes': nodes }
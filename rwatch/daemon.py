@@ -22,7 +22,7 @@ from setproctitle import setproctitle
 from flask import Flask, json, make_response, request
 
 from rwatch.logthis import *
-from rwatch import queue, jabber, db, ruleparser, tclient, gitinfo, __version__, __date__
+from rwatch import queue, jabber, db, ruleparser, tclient, metrics, supervisor, cluster, spool, watch, __version__, __date__
 from rwatch.util import *
 
 # rainwatch server Flask object
@@ -44,8 +44,13 @@ def start(xconfig):
     setproctitle("rainwatch: master process (%s:%d)" % (xconfig.srv['iface'], xconfig.srv['port']))
     pidfile_set()
 
-    # spawn queue runners
-    queue.start(xconfig, 'xfer')
+    # start supervising child processes
+    supervisor.setup(xconfig)
+
+    # spawn queue runners for each pipeline stage, and the jabber handler; all of the
+    # initial children are forked before the master starts any other threads
+    for qname in queue.queues(xconfig):
+        queue.spawn_pool(xconfig, qname)
 
     # spawn jabber handler
     if xconfig.xmpp['user'] and xconfig.xmpp['pass']:
@@ -54,6 +59,10 @@ def start(xconfig):
     else:
         logthis("!! Not spawning Jabber client, no JID defined in rc file", loglevel=LL.WARNING)
 
+    # register with the cluster, and publish this node's load
+    if cluster.enabled(xconfig):
+        cluster.start(xconfig, lambda xr: queue.load(xr, xconfig), lambda xr, xn: queue.idle(xr, xconfig, xn))
+
     # connect to Redis
     rdx = db.redis({'host': xconfig.redis['host'], 'port': xconfig.redis['port'], 'db': xconfig.redis['db']},
                    prefix=xconfig.redis['prefix'])
@@ -61,6 +70,19 @@ def start(xconfig):
     # connect to torrent daemon
     dlx = tclient.TorrentClient(xconfig)
 
+    # drain completions spooled by the hook; the drain thread has its own torrent client connection
+    sdlx = tclient.TorrentClient(xconfig)
+    spool.start(xconfig, lambda thash, opts: submit(rdx, sdlx, thash, opts))
+
+    # accept completions from the lightweight hook (rainwatch-hook)
+    spool.listen(xconfig)
+
+    # detect completions directly, via torrent client events and polling; the poll
+    # thread has its own torrent client connection
+    wdlx = tclient.TorrentClient(xconfig)
+    watch.start(xconfig, rdx, wdlx,
+                lambda thash, size: queue.enqueue(rdx, queue.scope(queue.PIPELINE[0], config), thash, False, size=size))
+
     # create flask object, and map API routes
     xsrv = Flask('rainwatch')
     xsrv.add_url_rule('/', 'root', view_func=route_root, methods=['GET']) # same as /api/info
@@ -71,6 +93,13 @@ def start(xconfig):
     xsrv.add_url_rule('/api/torrent/getinfo', 'torrent_getinfo', view_func=torrent_getinfo, methods=['GET', 'POST'])
     xsrv.add_url_rule('/api/rules/list', 'rules_list', view_func=rules_list, methods=['GET', 'POST'])
     xsrv.add_url_rule('/api/queue/list', 'queue_list', view_func=queue_list, methods=['GET', 'POST'])
+    xsrv.add_url_rule('/api/queue/jobs', 'queue_jobs', view_func=queue_jobs, methods=['GET', 'POST'])
+    xsrv.add_url_rule('/api/queue/job/<jid>', 'queue_job', view_func=queue_job, methods=['GET', 'POST'])
+    xsrv.add_url_rule('/api/queue/job/<jid>/cancel', 'queue_job_cancel', view_func=queue_job_cancel, methods=['POST'])
+    xsrv.add_url_rule('/api/queue/job/<jid>/pause', 'queue_job_pause', view_func=queue_job_pause, methods=['POST'])
+    xsrv.add_url_rule('/api/queue/job/<jid>/resume', 'queue_job_resume', view_func=queue_job_resume, methods=['POST'])
+    xsrv.add_url_rule('/api/queue/metrics', 'queue_metrics', view_func=queue_metrics, methods=['GET', 'POST'])
+    xsrv.add_url_rule('/api/cluster', 'cluster', view_func=route_cluster, methods=['GET', 'POST'])
 
     # start flask listener
     logthis("Starting Flask...", loglevel=LL.VERBOSE)
@@ -164,9 +193,9 @@ def require_auth(rfunc):
     """
     wrapper for route callbacks to require authentication and check for proper headers
     """
-    def authwrap():
+    def authwrap(*args, **kwargs):
         if precheck():
-            resp = rfunc()
+            resp = rfunc(*args, **kwargs)
         else:
             resp = dresponse(*precheck(rheaders=True))
 
@@ -211,8 +240,9 @@ def route_root():
                 'author': "J. Hipps <jacob@ycnrg.org>",
                 'copyright': "Copyright (c) 2016 J. Hipps/Neo-Retro Group",
                 'license': "MIT",
-                'git': gitinfo,
-                'bw_graph': config.web['bw_graph']
+                'git': git_info_raw(),
+                'bw_graph': config.web['bw_graph'],
+                'workers': supervisor.status()
             }
     return dresponse(rinfo, "212 Version Info")
 
@@ -229,16 +259,31 @@ def route_chook():
     """
     deluge 'download complete' handler
     """
-    global rdx
+    global rdx, dlx
     logthis(">> Received chook request", loglevel=LL.VERBOSE)
 
     indata = request.json
-    jobid = queue.enqueue(rdx, "xfer", indata.get('thash', False), indata.get('opts', False))
+    jobid = submit(rdx, dlx, indata.get('thash', False), indata.get('opts', False))
     resp = dresponse({ 'status': "ok", 'message': "Queued as job %s" % (jobid) }, "201 Queued")
 
     return resp
 
 
+def submit(xredis, xdlx, thash, opts=False):
+    """
+    enqueue a completed torrent at the start of the pipeline; returns the job ID
+    """
+    global config
+
+    # get torrent size for the scheduler
+    tordata = xdlx.getTorrent(thash)
+    tsize = tordata.get('total_size', None) if tordata else None
+
+    jid = queue.enqueue(xredis, queue.scope(queue.PIPELINE[0], config), thash, opts, size=tsize)
+    watch.mark(xredis, config, thash)
+    return jid
+
+
 @require_auth
 def torrent_list():
     """
@@ -292,28 +337,154 @@ def rules_list():
 @require_auth
 def queue_list():
     """
-    return current queued (queue_xfer) and downloading (work_xfer) items
+    return current queued (queue_*, pqueue_* or stream_*), running (work_*:*), delayed (delayed_*),
+    dead-lettered (dead_*), paused (paused_*) and malformed (bad_*) items for each pipeline stage and
+    transfer profile; queued items are returned in the order they will be run, and each item has its
+    queue name set in `stage`
     """
     global rdx
 
-    # get queue data from redis
-    qxfer = rdx.lrange('queue_xfer', 0, -1)
-    wxfer = rdx.lrange('work_xfer', 0, -1)
+    qlist = { 'queued': [], 'active': [], 'delayed': [], 'dead': [], 'paused': [], 'bad': [] }
+    for qname in queue.queues(config):
+        # decode JSON data from queue items
+        for t in queue.queue_items(rdx, qname):
+            try:
+                titem = json.loads(t)
+                titem['stage'] = qname
+                titem['coalesced'] = (queue.merged(rdx, titem.get('origin', qname), titem.get('id')) or {}).get('count', 0)
+                qlist['queued'].append(titem)
+            except Exception as e:
+                logexc(e, "!! Failed to decode JSON from %s:" % (queue.queue_key(qname)))
+
+        # each worker in the pool has its own work list (or pending entries, for the stream backend)
+        for t, twid in queue.active_items(rdx, qname):
+            try:
+                titem = json.loads(t)
+                titem['stage'] = qname
+                titem['worker'] = twid
+                titem['coalesced'] = (queue.merged(rdx, titem.get('origin', qname), titem.get('id')) or {}).get('count', 0)
+                qlist['active'].append(titem)
+            except Exception as e:
+                logexc(e, "!! Failed to decode JSON from active %s job:" % (qname))
+
+        # jobs waiting to be retried, jobs that have exhausted their retries, and paused jobs
+        for tlist, traws in (('delayed', rdx.zrange('delayed_'+qname, 0, -1)),
+                             ('dead', rdx.lrange('dead_'+qname, 0, -1)),
+                             ('paused', rdx.lrange('paused_'+qname, 0, -1))):
+            for t in traws:
+                try:
+                    titem = json.loads(t)
+                    titem['stage'] = qname
+                    qlist[tlist].append(titem)
+                except Exception as e:
+                    logexc(e, "!! Failed to decode JSON from %s_%s:" % (tlist, qname))
+
+        # malformed job data quarantined by the queue runners; returned as-is
+        qlist['bad'] += rdx.lrange('bad_'+qname, 0, -1)
 
-    # decode JSON data from queue items
-    qlist = { 'queued': [], 'active': [] }
-    for t in qxfer:
-        try:
-            qlist['queued'].append(json.loads(t))
-        except Exception as e:
-            logexc(e, "!! Failed to decode JSON from queue_xfer:")
+    resp = dresponse(*make_success(qlist))
 
-    for t in wxfer:
-        try:
-            qlist['active'].append(json.loads(t))
-        except Exception as e:
-            logexc(e, "!! Failed to decode JSON from work_xfer:")
+    return resp
 
-    resp = dresponse(*make_success(qlist))
+
+@require_auth
+def queue_jobs():
+    """
+    return a page of job state hashes, newest first
+    args: { offset: OFFSET (default 0), limit: LIMIT (default 50) }
+    """
+    global rdx
+
+    indata = request.get_json(silent=True) or {}
+    try:
+        offset = max(0, int(indata.get('offset', request.args.get('offset', 0))))
+        limit = min(1000, max(1, int(indata.get('limit', request.args.get('limit', 50)))))
+    except (TypeError, ValueError):
+        return dresponse(*make_fail("bad_params", "Parameters 'offset' and 'limit' must be integers"))
+
+    jlist = queue.joblist(rdx, offset, limit)
+    return dresponse(*make_success({ 'offset': offset, 'limit': limit, 'total': rdx.zcard('jobs'), 'jobs': jlist }))
+
+
+@require_auth
+def queue_job(jid):
+    """
+    return the state hash for a single job
+    """
+    global rdx
+
+    jinfo = queue.jobinfo(rdx, jid)
+    if jinfo:
+        resp = dresponse(*make_success(jinfo))
+    else:
+        resp = dresponse(*make_fail("not_found", "No such job: %s" % (jid), "404 Not Found"))
+
+    return resp
+
+
+@require_auth
+def queue_job_cancel(jid):
+    """
+    cancel a waiting or running job
+    """
+    global rdx
+    return job_control(jid, 'cancel')
+
+
+@require_auth
+def queue_job_pause(jid):
+    """
+    pause a waiting or running job; paused jobs are held in paused_* until resumed
+    """
+    global rdx
+    return job_control(jid, 'pause')
+
+
+def job_control(jid, action):
+    """
+    apply a control action to a job, and return the resulting state
+    """
+    global rdx
+
+    jstate = queue.control(rdx, (queue.jobinfo(rdx, jid) or {}).get('queue', 'xfer'), jid, action)
+    if jstate == "not_stoppable":
+        resp = dresponse(*make_fail("not_stoppable", "Running job is not in the xfer stage: %s" % (jid), "409 Conflict"))
+    elif jstate:
+        resp = dresponse(*make_success({ 'id': jid, 'state': jstate }))
+    else:
+        resp = dresponse(*make_fail("not_found", "No waiting or running job: %s" % (jid), "404 Not Found"))
+
+    return resp
+
+
+@require_auth
+def queue_job_resume(jid):
+    """
+    requeue a paused job
+    """
+    global rdx
+
+    if queue.resume(rdx, (queue.jobinfo(rdx, jid) or {}).get('queue', 'xfer'), jid):
+        resp = dresponse(*make_success({ 'id': jid, 'state': "queued" }))
+    else:
+        resp = dresponse(*make_fail("not_found", "No paused job: %s" % (jid), "404 Not Found"))
 
     return resp
+
+
+@require_auth
+def queue_metrics():
+    """
+    return job lifecycle histograms and rolling throughput counters
+    """
+    global rdx
+    return dresponse(*make_success(metrics.report(rdx)))
+
+
+@require_auth
+def route_cluster():
+    """
+    return the cluster leader, and the status and per-queue load of each node
+    """
+    global rdx, config
+    return dresponse(*make_success(cluster.report(rdx, config)))
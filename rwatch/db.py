@@ -117,6 +117,7 @@ class redis:
     rpipe = None
     conndata = {}
     rprefix = 'hota'
+    scripts = None
     silence = False
 
     def __init__(self, cdata={}, prefix='', silence=False):
@@ -127,6 +128,7 @@ class redis:
             self.conndata = cdata
         if prefix:
             self.rprefix = prefix
+        self.scripts = {}
         try:
             self.rcon = xredis.Redis(encoding='utf-8', decode_responses=True, **self.conndata)
         except Exception as e:
@@ -137,22 +139,22 @@ class redis:
             logthis("Connected to Redis OK", loglevel=LL.INFO, ccode=C.GRN)
 
 
-    def set(self, xkey, xval, usepipe=False, noprefix=False):
+    def set(self, xkey, xval, usepipe=False, noprefix=False, nx=False, ex=None):
         if noprefix: zkey = xkey
         else:        zkey = '%s:%s' % (self.rprefix, xkey)
         if usepipe:
-            xrez = self.rpipe.set(zkey, xval)
+            xrez = self.rpipe.set(zkey, xval, nx=nx, ex=ex)
         else:
-            xrez = self.rcon.set(zkey, xval)
+            xrez = self.rcon.set(zkey, xval, nx=nx, ex=ex)
         return xrez
 
     def setex(self, xkey, xval, expiry, usepipe=False, noprefix=False):
         if noprefix: zkey = xkey
         else:        zkey = '%s:%s' % (self.rprefix, xkey)
         if usepipe:
-            xrez = self.rpipe.setex(zkey, xval, expiry)
+            xrez = self.rpipe.setex(zkey, expiry, xval)
         else:
-            xrez = self.rcon.setex(zkey, xval, expiry)
+            xrez = self.rcon.setex(zkey, expiry, xval)
         return xrez
 
     def get(self, xkey, usepipe=False, noprefix=False):
@@ -171,6 +173,22 @@ class redis:
             xrez = self.rcon.incr('%s:%s' % (self.rprefix, xkey))
         return xrez
 
+    def delete(self, xkey, noprefix=False):
+        if noprefix: zkey = xkey
+        else:        zkey = '%s:%s' % (self.rprefix, xkey)
+        return self.rcon.delete(zkey)
+
+    def expire(self, xkey, expiry, noprefix=False):
+        if noprefix: zkey = xkey
+        else:        zkey = '%s:%s' % (self.rprefix, xkey)
+        return self.rcon.expire(zkey, expiry)
+
+    def incrby(self, xkey, amount):
+        return self.rcon.incrby('%s:%s' % (self.rprefix, xkey), amount)
+
+    def mget(self, xkeys):
+        return self.rcon.mget([ '%s:%s' % (self.rprefix, k) for k in xkeys ])
+
     def exists(self, xkey, noprefix=False):
         return self.rcon.exists('%s:%s' % (self.rprefix, xkey))
 
@@ -179,6 +197,15 @@ class redis:
         else:        zkey = '%s:%s' % (self.rprefix, xkey)
         return self.rcon.keys(zkey)
 
+    def sadd(self, xkey, *values):
+        return self.rcon.sadd('%s:%s' % (self.rprefix, xkey), *values)
+
+    def srem(self, xkey, *values):
+        return self.rcon.srem('%s:%s' % (self.rprefix, xkey), *values)
+
+    def smembers(self, xkey):
+        return self.rcon.smembers('%s:%s' % (self.rprefix, xkey))
+
     def makepipe(self):
         try:
             self.rpipe = self.rcon.pipeline()
@@ -194,6 +221,39 @@ class redis:
     def count(self):
         return self.rcon.dbsize()
 
+    def register_script(self, sname, lua):
+        """register a Lua script; it is loaded on first use via EVALSHA"""
+        self.scripts[sname] = self.rcon.register_script(lua)
+        return self.scripts[sname]
+
+    def runscript(self, sname, keys=[], args=[], noprefix=False):
+        """run a registered Lua script; keys are prefixed, args are passed as-is"""
+        if noprefix: zkeys = keys
+        else:        zkeys = [ '%s:%s' % (self.rprefix, k) for k in keys ]
+        return self.scripts[sname](keys=zkeys, args=args)
+
+    def hset(self, xkey, mapping):
+        return self.rcon.hset(self.rprefix+":"+xkey, mapping=mapping)
+
+    def hget(self, xkey, field):
+        return self.rcon.hget(self.rprefix+":"+xkey, field)
+
+    def hgetall(self, xkey):
+        return self.rcon.hgetall(self.rprefix+":"+xkey)
+
+    def hgetall_multi(self, xkeys):
+        """fetch multiple hashes in a single round trip"""
+        xpipe = self.rcon.pipeline(transaction=False)
+        for tk in xkeys:
+            xpipe.hgetall(self.rprefix+":"+tk)
+        return xpipe.execute()
+
+    def hincrby(self, xkey, field, amount=1):
+        return self.rcon.hincrby(self.rprefix+":"+xkey, field, amount)
+
+    def hincrbyfloat(self, xkey, field, amount):
+        return self.rcon.hincrbyfloat(self.rprefix+":"+xkey, field, amount)
+
     def lrange(self, qname, start, stop):
         return self.rcon.lrange(self.rprefix+":"+qname, start, stop)
 
@@ -206,6 +266,9 @@ class redis:
     def lpush(self, qname, xval):
         return self.rcon.lpush(self.rprefix+":"+qname, xval)
 
+    def lrem(self, qname, count, xval):
+        return self.rcon.lrem(self.rprefix+":"+qname, count, xval)
+
     def rpop(self, qname):
         return self.rcon.rpop(self.rprefix+":"+qname)
 
@@ -221,6 +284,65 @@ class redis:
     def brpoplpush(self, qsname, qdname, timeout=0):
         return self.rcon.brpoplpush(self.rprefix+":"+qsname, self.rprefix+":"+qdname, timeout)
 
+    def zadd(self, qname, xval, score):
+        return self.rcon.zadd(self.rprefix+":"+qname, {xval: score})
+
+    def zrem(self, qname, xval):
+        return self.rcon.zrem(self.rprefix+":"+qname, xval)
+
+    def zscore(self, qname, xval):
+        return self.rcon.zscore(self.rprefix+":"+qname, xval)
+
+    def zrangebyscore(self, qname, smin, smax):
+        return self.rcon.zrangebyscore(self.rprefix+":"+qname, smin, smax)
+
+    def zrevrange(self, qname, start, stop):
+        return self.rcon.zrevrange(self.rprefix+":"+qname, start, stop)
+
+    def zremrangebyscore(self, qname, smin, smax):
+        return self.rcon.zremrangebyscore(self.rprefix+":"+qname, smin, smax)
+
+    def zcard(self, qname):
+        return self.rcon.zcard(self.rprefix+":"+qname)
+
+    def zrange(self, qname, start, stop, withscores=False):
+        return self.rcon.zrange(self.rprefix+":"+qname, start, stop, withscores=withscores)
+
+    def bzpopmin(self, qname, timeout=0):
+        return self.rcon.bzpopmin(self.rprefix+":"+qname, timeout)
+
+    def xadd(self, sname, fields):
+        return self.rcon.xadd(self.rprefix+":"+sname, fields)
+
+    def xlen(self, sname):
+        return self.rcon.xlen(self.rprefix+":"+sname)
+
+    def xrange(self, sname, smin='-', smax='+', count=None):
+        return self.rcon.xrange(self.rprefix+":"+sname, smin, smax, count)
+
+    def xdel(self, sname, *mids):
+        return self.rcon.xdel(self.rprefix+":"+sname, *mids)
+
+    def xgroup_create(self, sname, group, mid='$', mkstream=False):
+        return self.rcon.xgroup_create(self.rprefix+":"+sname, group, id=mid, mkstream=mkstream)
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        zstreams = { self.rprefix+":"+sk: sv for sk, sv in streams.items() }
+        return self.rcon.xreadgroup(group, consumer, zstreams, count=count, block=block)
+
+    def xack(self, sname, group, *mids):
+        return self.rcon.xack(self.rprefix+":"+sname, group, *mids)
+
+    def xclaim(self, sname, group, consumer, min_idle, mids, justid=False):
+        return self.rcon.xclaim(self.rprefix+":"+sname, group, consumer, min_idle, mids, justid=justid)
+
+    def xautoclaim(self, sname, group, consumer, min_idle, start='0-0', count=None, justid=False):
+        return self.rcon.xautoclaim(self.rprefix+":"+sname, group, consumer, min_idle, start_id=start,
+                                    count=count, justid=justid)
+
+    def xpending_range(self, sname, group, smin, smax, count, consumer=None):
+        return self.rcon.xpending_range(self.rprefix+":"+sname, group, smin, smax, count, consumername=consumer)
+
     def __del__(self):
         pass
         #if not self.silence: logthis("Disconnected from Redis")
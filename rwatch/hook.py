@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.hook
+Rainwatch > Lightweight completion hook
+
+Entry point for the torrent client's completion hook (rainwatch-hook). Sends the
+torrent hash to the daemon over its Unix socket and exits; all other work is done
+by the daemon. Only the standard library is used here, so that the hook starts
+quickly. If the daemon can't be reached, the full 'rainwatch <TORRENT_ID>' hook
+is run instead
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import sys
+import os
+import re
+import json
+import socket
+import configparser
+
+from rwatch import defaults, rcfiles
+
+# Seconds to wait for the daemon to acknowledge a completion
+TIMEOUT = 5.0
+
+
+def sock_path():
+    """
+    returns the path to the daemon's hook socket, read from the first rc file
+    found (the same search order as rwatch.rcfile)
+    """
+    spath = defaults['srv']['socket']
+    for tf in rcfiles:
+        ttf = os.path.expanduser(tf)
+        if os.path.isfile(ttf):
+            rcpar = configparser.RawConfigParser()
+            try:
+                with open(ttf, 'r', encoding='utf-8') as f:
+                    rcpar.read_file(f)
+                spath = rcpar.get('srv', 'socket', fallback=spath)
+            except configparser.Error:
+                pass
+            break
+    rxm = re.match('^([\"\'])(.+)(\\1)$', spath)
+    if rxm:
+        spath = rxm.groups()[1]
+    return os.path.realpath(os.path.expanduser(spath))
+
+
+def send(thash, opts=False):
+    """
+    send a completion to the daemon; returns True once the daemon has spooled it
+    """
+    hsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hsock.settimeout(TIMEOUT)
+    try:
+        hsock.connect(sock_path())
+        hsock.sendall((json.dumps({ 'thash': thash, 'opts': opts }) + "\n").encode('utf-8'))
+        hsock.shutdown(socket.SHUT_WR)
+        rline = hsock.makefile('rb').readline().decode('utf-8', 'replace').strip()
+    finally:
+        hsock.close()
+    if rline != "OK":
+        raise Exception("daemon refused completion: %s" % (rline or "no response"))
+    return True
+
+
+def _main():
+    """entry point"""
+    targs = [ x for x in sys.argv[1:] if not x.startswith('-') ]
+    if not targs:
+        sys.stderr.write("usage: %s <TORRENT_ID> [NAME PATH]\n" % (os.path.basename(sys.argv[0])))
+        sys.exit(1)
+
+    try:
+        send(targs[0])
+        sys.exit(0)
+    except Exception as e:
+        sys.stderr.write("rainwatch-hook: failed to reach daemon (%s); running full hook\n" % (e))
+
+    # daemon is down or unreachable; the full hook spools the completion itself
+    from rwatch import cli
+    sys.argv = [ 'rainwatch', '-q', targs[0] ]
+    cli._main()
+
+
+if __name__ == '__main__':
+    _main()
@@ -31,7 +31,7 @@ from sleekxmpp.exceptions import IqError, IqTimeout, XMPPError
 from sleekxmpp.version import __version__ as sleekxmpp_version
 
 from rwatch import __version__, __date__
-from rwatch import db
+from rwatch import db, supervisor
 from rwatch.logthis import *
 
 # valid presence states
@@ -48,22 +48,20 @@ def spawn(xconfig):
     global conf
     conf = xconfig
 
-    # Fork into its own process
+    # Fork into its own supervised process
     logthis("Forking...", loglevel=LL.DEBUG)
-    dadpid = os.getpid()
-    try:
-        pid = os.fork()
-    except OSError as e:
-        logthis("os.fork() failed:", suffix=e, loglevel=LL.ERROR)
-        failwith(ER.PROCFAIL, "Failed to fork worker. Aborting.")
-
-    # Return if we are the parent process
-    if pid:
-        return 0
-
-    # Otherwise, we are the child
+    return supervisor.spawn("jabber", run, xconfig)
+
+
+def run(xconfig):
+    """
+    jabber client process entry point
+    """
+    global conf
+    conf = xconfig
+
     logthis("Forked jabber client. pid =", suffix=os.getpid(), loglevel=LL.INFO)
-    logthis("Jabber ppid =", suffix=dadpid, loglevel=LL.VERBOSE)
+    logthis("Jabber ppid =", suffix=os.getppid(), loglevel=LL.VERBOSE)
     setproctitle("rainwatch: jabber")
 
     # Connect to Redis
@@ -104,7 +102,7 @@ def spawn(xconfig):
                     logexc(e, "!! Failed to call method '%s':" % (qmsg.get('method', "[NONE]")))
 
         # check if parent is alive
-        if not master_alive(dadpid):
+        if not supervisor.master_alive():
             logthis("Jabber: Master has terminated.", loglevel=LL.WARNING)
             break
 
@@ -149,15 +147,6 @@ def recv(timeout=False):
     return outmsg
 
 
-def master_alive(ppid):
-    try:
-        os.kill(ppid, 0)
-    except OSError:
-        return False
-    else:
-        return True
-
-
 class XClient(ClientXMPP):
     host_override = ()
     avatar_path = None
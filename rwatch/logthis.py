@@ -25,10 +25,8 @@ import socket
 import syslog
 from urllib.parse import urlparse
 
-import arrow
-import zmq
-
-from rwatch.db import mongo, redis
+# arrow, zmq and the database drivers are imported where they are used, so that
+# importing rwatch (eg. from the completion hook) doesn't load them
 
 class C:
     """ANSI Colors"""
@@ -147,6 +145,7 @@ class loggerMaster():
             if self.log_pid:
                 spid = "(%d) " % (lpid)
             if self.log_time:
+                import arrow
                 tformat = arrow.get(tepoch).format("YYYY-MM-DD HH:mm:ss.SSS") + " "
             if self.log_level:
                 slevel = "%s: " % (LL.lname[loglevel].upper())
@@ -156,7 +155,7 @@ class loggerMaster():
                        rfunction=fname, rline=linenum, rpid=lpid, rlevel=loglevel, **kwargs)
 
     def startup(self):
-        from rwatch import __version__, __date__, gitinfo
+        from rwatch import __version__, __date__
         prxname = os.path.basename(sys.argv[0])
         self.log("Logging started: %s - Version %s (%s)\n" % (prxname, __version__, __date__), LL.INFO)
         self.ready = True
@@ -204,6 +203,7 @@ class loggerMongo(loggerMaster):
     collection = 'log'
 
     def __init__(self, uri, loglevel=None, collection='log', use_capped=True, capsize=1000000):
+        from rwatch.db import mongo
         self.__mon = mongo(uri)
         self.collection = collection
         if loglevel is not None:
@@ -234,6 +234,7 @@ class loggerZMQ(loggerMaster):
     __socket = None
 
     def __init__(self, uri, loglevel=None):
+        import zmq
         uri = uri.replace('zmq+', '')
         if loglevel is not None:
             self.loglevel = loglevel
@@ -460,9 +461,11 @@ def print_r(ind):
     return json.dumps(ind, indent=4, separators=(',', ': '))
 
 def isotimenow():
+    import arrow
     return arrow.utcnow().format(r"YYYY-MM-DDTHH:mm:ss.SSS")+"Z"
 
 def isotime(tstamp):
+    import arrow
     return arrow.get(tstamp).format(r"YYYY-MM-DDTHH:mm:ss.SSS")+"Z"
 
 def configure_logger(xconfig):
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.metrics
+Rainwatch > Job lifecycle metrics
+
+Per-stage duration histograms and rolling throughput counters, stored in Redis
+so that they are shared by all queue runners
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import time
+
+from rwatch.logthis import *
+
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 21600)
+
+# Job lifecycle stages; 'move', 'verify' and 'notify' are the durations of the
+# corresponding pipeline stages, while xfer is broken down into its own steps
+STAGES = ('queue_wait', 'move', 'torrent_info', 'ssh_connect', 'df', 'copy', 'verify', 'notify', 'total')
+
+# Rolling counter windows, in minutes
+WINDOWS = (1, 5, 15, 60)
+
+# Rolling counters are kept in per-minute buckets, which expire after this many seconds
+COUNTER_TTL = (max(WINDOWS) + 5) * 60
+
+
+def bucket(secs):
+    """
+    returns the label of the bucket a duration is stored in; each sample is stored
+    only in the smallest bucket that holds it, and report() makes the counts cumulative
+    """
+    for tb in BUCKETS:
+        if secs <= tb:
+            return "le_%s" % (tb)
+    return "le_inf"
+
+
+def observe(xredis, stage, secs):
+    """
+    record a duration (in seconds) for the specified stage
+    """
+    hkey = "metrics:hist:%s" % (stage)
+    try:
+        xredis.hincrby(hkey, bucket(secs), 1)
+        xredis.hincrby(hkey, 'count', 1)
+        xredis.hincrbyfloat(hkey, 'sum', secs)
+    except Exception as e:
+        logexc(e, "Failed to record metrics for stage '%s'" % (stage))
+
+
+def count(xredis, jobs=0, nbytes=0):
+    """
+    add finished jobs and/or transferred bytes to the rolling counters
+    """
+    tmin = int(time.time() // 60)
+    try:
+        if jobs:
+            xredis.incrby("metrics:jobs:%d" % (tmin), jobs)
+            xredis.expire("metrics:jobs:%d" % (tmin), COUNTER_TTL)
+        if nbytes:
+            xredis.incrby("metrics:bytes:%d" % (tmin), int(nbytes))
+            xredis.expire("metrics:bytes:%d" % (tmin), COUNTER_TTL)
+    except Exception as e:
+        logexc(e, "Failed to update rolling counters")
+
+
+def throughput(xredis, twin=1):
+    """
+    returns the transfer rate over the last `twin` minutes, in bytes per second
+    """
+    tmin = int(time.time() // 60)
+    bcounts = xredis.mget([ "metrics:bytes:%d" % (tmin - x) for x in range(twin) ])
+    tsecs = max(1.0, ((twin - 1) * 60) + (time.time() - (tmin * 60)))
+    return sum([ int(x or 0) for x in bcounts ]) / tsecs
+
+
+def report(xredis):
+    """
+    returns histograms for all stages, plus jobs per minute and bytes per second
+    for each rolling window. Rates include the current (partial) minute. As in
+    Prometheus, histogram buckets are cumulative: `le_<N>` is the number of
+    samples of at most N seconds, and `le_inf` is the total
+    """
+    hists = {}
+    for tstage, hraw in zip(STAGES, xredis.hgetall_multi([ "metrics:hist:%s" % (x) for x in STAGES ])):
+        tcount = int(hraw.get('count', 0))
+        tsum = float(hraw.get('sum', 0))
+        tbuckets = {}
+        tcum = 0
+        for tb in BUCKETS:
+            tcum += int(hraw.get(bucket(tb), 0))
+            tbuckets[bucket(tb)] = tcum
+        tbuckets['le_inf'] = tcum + int(hraw.get('le_inf', 0))
+        hists[tstage] = {
+                            'buckets': tbuckets,
+                            'count': tcount,
+                            'sum': tsum,
+                            'mean': (tsum / tcount) if tcount else None
+                        }
+
+    # fetch the per-minute counters for the largest window
+    tmin = int(time.time() // 60)
+    mlist = [ tmin - x for x in range(max(WINDOWS)) ]
+    jcounts = [ int(x or 0) for x in xredis.mget([ "metrics:jobs:%d" % (x) for x in mlist ]) ]
+    bcounts = [ int(x or 0) for x in xredis.mget([ "metrics:bytes:%d" % (x) for x in mlist ]) ]
+
+    # the current minute is only partially elapsed
+    tpartial = time.time() - (tmin * 60)
+    rates = {}
+    for twin in WINDOWS:
+        tsecs = max(1.0, ((twin - 1) * 60) + tpartial)
+        rates['%dm' % (twin)] = {
+                                    'jobs': sum(jcounts[:twin]),
+                                    'jobs_per_min': sum(jcounts[:twin]) / (tsecs / 60.0),
+                                    'bytes': sum(bcounts[:twin]),
+                                    'bytes_per_sec': sum(bcounts[:twin]) / tsecs
+                                }
+
+    return { 'histograms': hists, 'rates': rates, 'bucket_bounds': BUCKETS }
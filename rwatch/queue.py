@@ -19,49 +19,143 @@ import os
 import re
 import time
 import json
+import math
+import random
+import socket
+import threading
 from setproctitle import setproctitle
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from rwatch.logthis import *
 from rwatch.util import *
-from rwatch.ssh2 import rainshell
-from rwatch import db, jabber, tclient
+from rwatch.ssh2 import rainshell, XferAborted
+from rwatch import db, jabber, tclient, ruleparser, metrics, supervisor, bwlimit, cluster
 
 
+# Server-side scripts
+# Both scripts push job data on to the main queue according to ARGV[1] (see backend_mode());
+# jobs without a stored score are given ARGV[3] (the current time) in priority mode
+
+# KEYS: work list, main queue, bad list; ARGV: mode, lease key prefix, now
+# Requeues all valid jobs from the work list, releases their leases, and moves
+# anything that isn't valid job data to the bad list. Returns {requeued, bad}
+LUA_RECOVER = """
+local requeued, bad = 0, 0
+while true do
+    local raw = redis.call('LPOP', KEYS[1])
+    if not raw then break end
+    local ok, job = pcall(cjson.decode, raw)
+    if ok and type(job) == 'table' and job['id'] and job['thash'] then
+        redis.call('DEL', ARGV[2] .. tostring(job['id']))
+        if ARGV[1] == 'priority' then
+            redis.call('ZADD', KEYS[2], tonumber(job['score']) or tonumber(ARGV[3]), raw)
+        elseif ARGV[1] == 'stream' then
+            redis.call('XADD', KEYS[2], '*', 'job', raw)
+        else
+            redis.call('RPUSH', KEYS[2], raw)
+        end
+        requeued = requeued + 1
+    else
+        redis.call('LPUSH', KEYS[3], raw)
+        bad = bad + 1
+    end
+end
+return {requeued, bad}
+"""
+
+# KEYS: work list, main queue; ARGV: mode, raw job data, now
+# Atomically removes one job from a work list and requeues it. Returns 1 if the job
+# was requeued, or 0 if it was no longer in the work list
+LUA_REQUEUE = """
+if redis.call('LREM', KEYS[1], 1, ARGV[2]) == 0 then return 0 end
+if ARGV[1] == 'priority' then
+    local ok, job = pcall(cjson.decode, ARGV[2])
+    local score = ok and type(job) == 'table' and tonumber(job['score']) or tonumber(ARGV[3])
+    redis.call('ZADD', KEYS[2], score, ARGV[2])
+elseif ARGV[1] == 'stream' then
+    redis.call('XADD', KEYS[2], '*', 'job', ARGV[2])
+else
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+# KEYS: main queue (sorted set), work list
+# Atomically pops the job with the lowest score and pushes it on to the work list, so
+# that it is never in neither. Returns the raw job data, or nil if the queue is empty
+LUA_ZPOPWORK = """
+local zrez = redis.call('ZPOPMIN', KEYS[1])
+if #zrez == 0 then return false end
+redis.call('LPUSH', KEYS[2], zrez[1])
+return zrez[1]
+"""
+
+# How often the priority backend polls an empty queue, in seconds; there is no
+# blocking form of the atomic pop
+ZPOP_INTERVAL = 0.25
+
+# Job pipeline; each stage has its own queue and pool of queue runners, and jobs are
+# handed off to the next stage when a stage completes
+PIPELINE = ('move', 'xfer', 'verify', 'notify')
+
+# Job handler return codes for jobs stopped via the control key (jobctl_*)
+ctlvals = {
+            'cancel': 2,
+            'pause': 3,
+            'preempt': 4
+          }
+
+# Job handler failure codes
+rvals = {
+            100: "Unhandled exception in job handler",
+            101: "Failed to retrieve torrent data",
+            102: "Failed to establish SSH connection",
+            103: "Transfer failed",
+            104: "Failed to move torrent data",
+            105: "Transferred files failed verification"
+        }
+
 # Queue handler callbacks
 handlers = None
 conf = None
 
-# Redis object, Deluge client, Parent PID
+# Redis object, Deluge client
 rdx = None
 dlx = None
-dadpid = None
 
-def start(xconfig, qname="xfer"):
-    global rdx, dlx, dadpid, handlers, conf
+# Jobs seen without a lease on the last reaper pass, per queue
+suspects = {}
+
+# Stream backend: consumer name, and whether there are pending entries to read first
+consumer = None
+backlog = False
+
+# Master process: worker IDs of the running queue runners, per queue
+pool = {}
+
+def start(xconfig, qname="xfer", wid=0):
+    global conf
     conf = xconfig
 
-    # Fork into its own process
+    # Fork into its own supervised process
     logthis("Forking...", loglevel=LL.DEBUG)
-    dadpid = os.getpid()
-    try:
-        pid = os.fork()
-    except OSError as e:
-        logthis("os.fork() failed:", suffix=e, loglevel=LL.ERROR)
-        failwith(ER.PROCFAIL, "Failed to fork worker. Aborting.")
+    return supervisor.spawn("%s/%d" % (qname, wid), run, xconfig, qname, wid)
 
-    # Return if we are the parent process
-    if pid:
-        return 0
+def run(xconfig, qname="xfer", wid=0):
+    """
+    queue runner process entry point
+    """
+    global rdx, dlx, handlers, conf
+    conf = xconfig
 
-    # Otherwise, we are the child
-    logthis("Forked queue runner. pid =", prefix=qname, suffix=os.getpid(), loglevel=LL.INFO)
-    logthis("QRunner. ppid =", prefix=qname, suffix=dadpid, loglevel=LL.VERBOSE)
-    setproctitle("rainwatch: queue runner - %s" % (qname))
+    logthis("Forked queue runner %d. pid =" % (wid), prefix=qname, suffix=os.getpid(), loglevel=LL.INFO)
+    logthis("QRunner. ppid =", prefix=qname, suffix=os.getppid(), loglevel=LL.VERBOSE)
+    setproctitle("rainwatch: queue runner - %s/%d" % (qname, wid))
 
     # Connect to Redis
     rdx = db.redis({ 'host': conf.redis['host'], 'port': conf.redis['port'], 'db': conf.redis['db'] },
                    prefix=conf.redis['prefix'])
+    register_scripts(rdx)
 
     # Connect to torrent client
     dlx = tclient.TorrentClient(xconfig)
@@ -71,111 +165,619 @@ def start(xconfig, qname="xfer"):
 
     # Set queue callbacks
     handlers = {
-                 'xfer': cb_xfer
+                 'move': cb_move,
+                 'xfer': cb_xfer,
+                 'verify': cb_verify,
+                 'notify': cb_notify
                }
 
     # Start listener loop
-    qrunner(qname)
+    qrunner(qname, wid)
 
     # And exit once we're done
     logthis("*** Queue runner terminating", prefix=qname, loglevel=LL.INFO)
     sys.exit(0)
 
-def qrunner(qname="xfer"):
-    global rdx, mdx, handlers
+def register_scripts(xredis):
+    """
+    register server-side scripts used by the queue runner
+    """
+    xredis.register_script('recover', LUA_RECOVER)
+    xredis.register_script('requeue', LUA_REQUEUE)
+    xredis.register_script('zpopwork', LUA_ZPOPWORK)
+    cluster.register_scripts(xredis)
+    bwlimit.register_scripts(xredis)
 
-    qq = "queue_"+qname
-    wq = "work_"+qname
+def spawn_pool(xconfig, qname="xfer"):
+    """
+    fork a pool of queue runners for the specified queue
+    pool size is set by the `workers` option in the [queue] section (`<stage>_workers`
+    for pipeline stages other than xfer); if `workers_max` is larger, the xfer pool
+    is resized between the two by the autoscaler
+    """
+    global pool
+    nworkers = pool_size(xconfig, qname)
+    logthis("Spawning %d queue runner(s) for queue:" % (nworkers), suffix=qname, loglevel=LL.VERBOSE)
+    pool[qname] = set()
+    for wid in range(nworkers):
+        start(xconfig, qname, wid)
+        pool[qname].add(wid)
+
+    if unscope(qname) == 'xfer' and int(xconfig.queue['workers_max']) > nworkers:
+        athread = threading.Thread(target=autoscale, args=(xconfig, qname), name="autoscale_"+qname, daemon=True)
+        athread.start()
+
+    return nworkers
+
+def pool_size(xconfig, qname):
+    """
+    returns the configured number of queue runners for `qname`
+    """
+    if unscope(qname) == 'xfer':
+        return max(1, int(xconfig.queue['workers']))
+    elif stage(qname) == 'xfer':
+        return max(1, int(xfer_profile(xconfig, unscope(qname).split('.', 1)[1])['workers']))
+    return max(1, int(xconfig.queue['%s_workers' % (stage(qname))]))
+
+def autoscale(xconfig, qname="xfer"):
+    """
+    autoscaler thread, run in the master process; grows and shrinks the pool of
+    queue runners for `qname` between `workers` and `workers_max`, based on
+    queue depth, queued bytes and link utilisation
+    """
+    global pool
+
+    xredis = db.redis({ 'host': xconfig.redis['host'], 'port': xconfig.redis['port'], 'db': xconfig.redis['db'] },
+                      prefix=xconfig.redis['prefix'])
+    wmin = max(1, int(xconfig.queue['workers']))
+    wmax = int(xconfig.queue['workers_max'])
+    logthis("Autoscaler started; pool size %d - %d, queue:" % (wmin, wmax), suffix=qname, loglevel=LL.VERBOSE)
+
+    lastscale = time.time()
+    while True:
+        time.sleep(float(xconfig.queue['scale_interval']))
+        if (time.time() - lastscale) < float(xconfig.queue['scale_cooldown']):
+            continue
 
-    # Crash recovery
-    # Check work queue (work_*) and re-queue any unhandled items
-    logthis("-- QRunner crash recovery: checking for abandoned jobs...", loglevel=LL.VERBOSE)
-    requeued = 0
-    while(rdx.llen(wq) != 0):
-        crraw = rdx.lpop(wq)
         try:
-            critem = json.loads(crraw)
+            target, sinfo = scale_target(xredis, qname, len(pool[qname]), wmin, wmax)
+            if target > len(pool[qname]):
+                logthis("Autoscaler: growing pool from %d to %d; state:" % (len(pool[qname]), target),
+                        prefix=qname, suffix=sinfo, loglevel=LL.INFO)
+                grow(xconfig, qname, target - len(pool[qname]))
+                lastscale = time.time()
+            elif target < len(pool[qname]):
+                logthis("Autoscaler: shrinking pool from %d to %d; state:" % (len(pool[qname]), target),
+                        prefix=qname, suffix=sinfo, loglevel=LL.INFO)
+                if shrink(xredis, qname, len(pool[qname]) - target):
+                    lastscale = time.time()
         except Exception as e:
-            logthis("!! QRunner crash recovery: Bad JSON data from queue item. Job discarded. raw data:",
-                    prefix=qname, suffix=crraw, loglevel=LL.ERROR)
+            logexc(e, "!! Autoscaler: failed to resize pool", prefix=qname)
+
+def scale_target(xredis, qname, nworkers, wmin, wmax):
+    """
+    returns the number of queue runners wanted for `qname`, and a dict of the queue
+    state it was based on. Each busy runner is kept, and one runner is added per waiting
+    job (or per `scale_bytes` of waiting data); the pool is not grown while measured
+    throughput is at or above `link_target` of `link_capacity`
+    """
+    global conf
+
+    busy = len(active_items(xredis, qname))
+    qlist = queue_items(xredis, qname)
+    qbytes = 0
+    for traw in qlist:
+        try:
+            qbytes += int(json.loads(traw).get('size') or 0)
+        except Exception:
+            pass
+
+    extra = len(qlist)
+    if float(conf.queue['scale_bytes']) > 0:
+        extra = min(extra, int(math.ceil(qbytes / float(conf.queue['scale_bytes']))))
+    want = busy + extra
+
+    util = None
+    if float(conf.queue['link_capacity']) > 0:
+        util = metrics.throughput(xredis, 1) / float(conf.queue['link_capacity'])
+        if util >= float(conf.queue['link_target']):
+            want = min(want, nworkers)
+
+    sinfo = { 'busy': busy, 'queued': len(qlist), 'queued_bytes': qbytes, 'link_util': util }
+    return max(wmin, min(wmax, want)), sinfo
+
+def grow(xconfig, qname, count):
+    """
+    start `count` additional queue runners for `qname`, using the lowest free worker IDs
+    """
+    global pool
+
+    running = supervisor.status()
+    wid = 0
+    while count > 0:
+        # skip IDs in use, including retired runners that have not exited yet
+        if wid not in pool[qname] and not running.get("%s/%d" % (qname, wid), {}).get('alive'):
+            start(xconfig, qname, wid)
+            pool[qname].add(wid)
+            count -= 1
+        wid += 1
+
+def shrink(xredis, qname, count):
+    """
+    retire up to `count` idle queue runners for `qname`, highest worker ID first;
+    retired runners exit the next time they are idle, and are not respawned.
+    Returns the number of runners retired
+    """
+    global pool
+
+    busy = set([ twid for traw, twid in active_items(xredis, qname) ])
+    retired = 0
+    for wid in sorted(pool[qname], reverse=True):
+        if retired >= count or len(pool[qname]) <= 1:
+            break
+        if wid in busy or consumer_name(wid) in busy:
             continue
-        cr_jid = critem.get("id", "??")
-        logthis("** Requeued abandoned job:", prefix=qname, suffix=cr_jid, loglevel=LL.WARNING)
-        rdx.rpush(qq, crraw)
-        requeued += 1
+        supervisor.retire("%s/%d" % (qname, wid))
+        # no TTL: a runner that picks up a job just before it sees the key must still
+        # retire once the job is done, however long it runs. Runners clear the key at start
+        xredis.set(retirekey(qname, wid), 1)
+        pool[qname].discard(wid)
+        retired += 1
+        logthis("Autoscaler: retired queue runner", prefix=qname, suffix=wid, loglevel=LL.VERBOSE)
 
+    return retired
+
+def retirekey(qname, wid):
+    """
+    returns the name of the key used to ask worker `wid` to exit
+    """
+    return "retire_%s:%d" % (qname, wid)
+
+def workq(qname, wid):
+    """
+    returns the name of the work list belonging to worker `wid`
+    """
+    return "work_%s:%d" % (qname, wid)
+
+def workers_key(qname):
+    """
+    returns the name of the set of worker IDs that have work lists for `qname`; it is
+    used to find the work lists without scanning the keyspace
+    """
+    return "workers_%s" % (qname)
+
+def recover(qname, wq):
+    """
+    crash recovery; re-queue any unhandled items left in work list `wq`, and
+    release their leases. This is done in a single round trip by the `recover`
+    script; items that are not valid job data are moved to the bad_* list
+    """
+    global rdx
+
+    requeued, bad = rdx.runscript('recover', keys=[wq, queue_key(qname), "bad_"+qname],
+                                  args=[backend_mode(), "%s:%s" % (rdx.rprefix, leasekey(qname, '')), time.time()])
+    if bad:
+        logthis("!! QRunner crash recovery: Bad job data found in work list; moved to %s:" % ("bad_"+qname),
+                prefix=qname, suffix=bad, loglevel=LL.ERROR)
+    if requeued:
+        logthis("** Requeued abandoned jobs:", prefix=qname, suffix=requeued, loglevel=LL.WARNING)
+
+    return requeued
+
+def migrate(qname):
+    """
+    move any jobs left in the main queue of a scheduler or backend that is not currently
+    in use (eg. after switching from 'fifo' to 'priority') on to the active queue
+    """
+    global rdx
+
+    moved = 0
+    if is_priority() or is_stream():
+        while True:
+            mraw = rdx.rpop("queue_"+qname)
+            if not mraw: break
+            push(rdx, qname, mraw)
+            moved += 1
+    if not is_priority():
+        for mraw in rdx.zrange("pqueue_"+qname, 0, -1):
+            if rdx.zrem("pqueue_"+qname, mraw):
+                push(rdx, qname, mraw)
+                moved += 1
+    if not is_stream():
+        for mid, mfields in rdx.xrange(stream_key(qname)):
+            # entries that are pending for a consumer are left for it to finish
+            if mfields and not rdx.xpending_range(stream_key(qname), conf.queue['group'], mid, mid, 1):
+                if rdx.xdel(stream_key(qname), mid):
+                    push(rdx, qname, mfields['job'])
+                    moved += 1
+
+    if moved:
+        logthis("** Migrated jobs from inactive scheduler queue:", prefix=qname, suffix=moved, loglevel=LL.WARNING)
+    return moved
+
+def worklists(qname):
+    """
+    returns a list of all work lists for the specified queue, including the
+    pre-pool `work_<qname>` list and lists left behind by workers that no
+    longer exist after reducing the pool size
+    """
+    global rdx
+
+    wlist = [ "work_"+qname ]
+    for twid in sorted([ int(x) for x in rdx.smembers(workers_key(qname)) ]):
+        wlist.append(workq(qname, twid))
+
+    return wlist
+
+def leasekey(qname, jid):
+    """
+    returns the name of the lease key for job `jid`
+    """
+    return "lease_%s:%s" % (qname, jid)
+
+def lease(qname, jid, wq, mid=None):
+    """
+    take out (or renew) a lease on job `jid`; the lease holds the name of the
+    work list that owns the job, and expires after `lease_ttl` seconds unless renewed.
+    With the stream backend, the pending entry `mid` is re-claimed by its owner, which
+    resets its idle time
+    """
+    global rdx, conf
+    if mid:
+        return rdx.xclaim(stream_key(qname), conf.queue['group'], wq, 0, [mid], justid=True)
+    return rdx.setex(leasekey(qname, jid), wq, int(conf.queue['lease_ttl']))
+
+def ack(qname, wq, qiraw, jid, mid=None):
+    """
+    acknowledge a finished job; removes the exact payload from work list `wq`
+    and releases its lease. With the stream backend, the entry `mid` is acknowledged
+    and deleted from the stream
+    """
+    global rdx, conf
+    if mid:
+        rdx.xack(stream_key(qname), conf.queue['group'], mid)
+        return rdx.xdel(stream_key(qname), mid)
+    rdx.delete(leasekey(qname, jid))
+    return rdx.lrem(wq, 1, qiraw)
+
+def heartbeat(qname, jid, wq, hbstop, mid=None):
+    """
+    lease heartbeat thread; renews the lease on job `jid` until `hbstop` is set
+    """
+    global conf
+    hbfreq = max(1.0, float(conf.queue['lease_ttl']) / 3.0)
+    while not hbstop.wait(hbfreq):
+        try:
+            lease(qname, jid, wq, mid)
+        except Exception as e:
+            logexc(e, "!! Failed to renew lease for job %s" % (jid), prefix=qname)
+
+def reap(qname):
+    """
+    requeue jobs whose lease has expired. A job must be seen without a lease on two
+    consecutive passes before it is requeued, which covers the short window between a
+    worker popping a job and taking out its lease
+    """
+    global rdx, suspects
+
+    if is_stream():
+        return reap_stream(qname)
+
+    lastsus = suspects.get(qname, set())
+    cursus = set()
+    requeued = 0
+
+    for twq in worklists(qname):
+        for traw in rdx.lrange(twq, 0, -1):
+            try:
+                tjid = json.loads(traw).get('id', None)
+            except Exception as e:
+                tjid = None
+            if tjid and rdx.exists(leasekey(qname, tjid)):
+                continue
+
+            if (twq, traw) in lastsus:
+                # only the reaper that wins the LREM gets to requeue the job
+                if rdx.runscript('requeue', keys=[twq, queue_key(qname)], args=[backend_mode(), traw, time.time()]):
+                    logthis("** Reaper: requeued job with expired lease:", prefix=qname,
+                            suffix="%s (from %s)" % (tjid, twq), loglevel=LL.WARNING)
+                    requeued += 1
+            else:
+                cursus.add((twq, traw))
+
+    suspects[qname] = cursus
+    return requeued
+
+def retry(qname, qitem, rval):
+    """
+    schedule a failed job to be retried with exponential backoff; once the job has
+    failed `max_attempts` times, it is moved to the dead-letter list (dead_*) instead
+    """
+    global rdx, conf
+
+    jid = qitem.get('id', "??")
+    qitem['attempts'] = qitem.get('attempts', 0) + 1
+    qitem['last_rval'] = rval
+    qitem['last_fail'] = time.time()
+
+    if qitem['attempts'] >= int(conf.queue['max_attempts']):
+        logthis("!! Job failed %d times; moved to dead-letter list:" % (qitem['attempts']), prefix=qname,
+                suffix=jid, loglevel=LL.ERROR)
+        rdx.lpush("dead_"+qname, json.dumps(qitem))
+        release(rdx, qname, qitem)
+        jobstate(rdx, jid, state="dead", finished=time.time(), attempts=qitem['attempts'], error=errstr(rval))
+        return None
+
+    # exponential backoff with 'equal' jitter; half of the delay is fixed, the other half is random,
+    # so that jobs that failed together (eg. due to a link outage) don't all retry at the same time
+    rdelay = min(float(conf.queue['retry_delay']) * (2 ** (qitem['attempts'] - 1)),
+                 float(conf.queue['retry_max_delay']))
+    rdelay = (rdelay / 2.0) + random.uniform(0, rdelay / 2.0)
+    qitem['retry_at'] = time.time() + rdelay
+
+    logthis("** Retrying job %s in %d seconds (attempt %d of %d)" %
+            (jid, rdelay, qitem['attempts'] + 1, int(conf.queue['max_attempts'])), prefix=qname, loglevel=LL.WARNING)
+    rdx.zadd("delayed_"+qname, json.dumps(qitem), qitem['retry_at'])
+    jobstate(rdx, jid, state="retry", attempts=qitem['attempts'], error=errstr(rval), retry_at=qitem['retry_at'])
+    return qitem['retry_at']
+
+def promote(qname):
+    """
+    move delayed jobs that are due to be retried back on to the main queue
+    """
+    global rdx
+
+    promoted = 0
+    for praw in rdx.zrangebyscore("delayed_"+qname, 0, time.time()):
+        # only the worker that wins the ZREM gets to requeue the job
+        if rdx.zrem("delayed_"+qname, praw):
+            push(rdx, qname, praw)
+            try:
+                jobstate(rdx, json.loads(praw)['id'], state="queued")
+            except Exception as e:
+                pass
+            promoted += 1
+
+    if promoted:
+        logthis(">> Promoted delayed jobs for retry:", prefix=qname, suffix=promoted, loglevel=LL.VERBOSE)
+    return promoted
+
+def reap_stream(qname):
+    """
+    claim one stalled stream entry (delivered to a consumer, but idle for longer
+    than `lease_ttl` seconds) for this worker; claimed entries are picked up from
+    the worker's backlog on its next dequeue
+    """
+    global rdx, conf, backlog
+
+    claimed = rdx.xautoclaim(stream_key(qname), conf.queue['group'], consumer, int(conf.queue['lease_ttl']) * 1000,
+                             count=1, justid=True) or []
+    if claimed:
+        logthis("** Reaper: claimed stalled stream entry:", prefix=qname, suffix=claimed[0], loglevel=LL.WARNING)
+        backlog = True
+    return len(claimed)
+
+def qrunner(qname="xfer", wid=0):
+    global rdx, mdx, handlers, conf, consumer, backlog
+
+    qq = queue_key(qname)
+    wq = workq(qname, wid)
+
+    # Crash recovery
+    # Check our work queue (work_*:<wid>) and re-queue any unhandled items; any other
+    # abandoned jobs are picked up by the reaper once their lease has expired.
+    # With the stream backend, entries still pending for this consumer are run first
+    logthis("-- QRunner crash recovery: checking for abandoned jobs...", prefix=qname, loglevel=LL.VERBOSE)
+    if is_stream():
+        consumer = consumer_name(wid)
+        wq = consumer
+        backlog = True
+        stream_setup(qname)
+        requeued = recover(qname, workq(qname, wid))
+    else:
+        requeued = recover(qname, wq)
+    if wid == 0:
+        requeued += migrate(qname)
     if requeued:
         logthis("-- QRunner crash recovery OK! Jobs requeued:", prefix=qname, suffix=requeued, loglevel=LL.VERBOSE)
 
-    logthis("pre-run queue sizes: %s = %d / %s = %d" % (qq, rdx.llen(qq), wq, rdx.llen(wq)),
-            prefix=qname, loglevel=LL.DEBUG)
+    # clear any retire request left over from a previous runner with the same ID
+    rdx.delete(retirekey(qname, wid))
+
+    # register this runner's work list, so that the reaper and active_items() can find it
+    rdx.sadd(workers_key(qname), wid)
+
+    logthis("pre-run queue size: %s = %d" % (qq, queue_len(rdx, qname)), prefix=qname, loglevel=LL.DEBUG)
     logthis("-- QRunner waiting; queue:", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
+    lastreap = 0
     while(True):
-        # RPOP from main queue and LPUSH on to the work queue
+        # Pop from main queue and LPUSH on to the work queue
         # block for 5 seconds, check that the master hasn't term'd, then
         # check again until we get something
         qitem = None
-        qiraw = rdx.brpoplpush(qq, wq, 5)
+        qiraw, qmid = dequeue(rdx, qname, wq, 5)
         if qiraw:
             logthis(">> QRunner: discovered a new job in queue", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
 
             try:
                 qitem = json.loads(qiraw)
             except Exception as e:
-                logthis("!! QRunner: Bad JSON data from queue item. Job discarded. raw data:",
+                logthis("!! QRunner: Bad JSON data from queue item. Job moved to %s. raw data:" % ("bad_"+qname),
                         prefix=qname, suffix=qiraw, loglevel=LL.ERROR)
+                rdx.lpush("bad_"+qname, qiraw)
+                ack(qname, wq, qiraw, None, qmid)
 
             # If we've got a valid job item, let's run it!
             if qitem:
                 logthis(">> QRunner: job data:\n", prefix=qname, suffix=json.dumps(qitem), loglevel=LL.DEBUG)
 
+                # Apply options from any coalesced enqueues
+                jid = qitem.get('id', None)
+                coalesce(rdx, qname, qitem)
+                if stage(qname) == 'xfer':
+                    jobstate(rdx, jid, bytes=0, rate=0)
+                jobstate(rdx, jid, state="active", queue=qname, started=time.time(), worker=wq, error="")
+                metrics.observe(rdx, 'queue_wait',
+                                time.time() - qitem.get('retry_at', qitem.get('handoff', qitem.get('ts', time.time()))))
+                tstart = time.time()
+
+                # Take out a lease on the job, and keep it alive while the job runs
+                lease(qname, jid, wq, qmid)
+                hbstop = threading.Event()
+                hbthread = threading.Thread(target=heartbeat, args=(qname, jid, wq, hbstop, qmid), daemon=True)
+                hbthread.start()
+
                 # Execute callback
-                rval = handlers[qname](qitem)
-                if (rval == 0):
+                try:
+                    rval = handlers[stage(qname)](qitem)
+                except Exception as e:
+                    logexc(e, "!! QRunner: Unhandled exception in job handler", prefix=qname)
+                    rval = 100
+                finally:
+                    hbstop.set()
+                    hbthread.join()
+
+                if stage(qname) in PIPELINE and stage(qname) != 'xfer':
+                    metrics.observe(rdx, stage(qname), time.time() - tstart)
+
+                if rval == 1:
+                    qitem['warning'] = True
+                if rval < 2 and nextstage(qname, qitem):
+                    logthis("QRunner: Stage complete; handing off to", prefix=qname,
+                            suffix=nextstage(qname, qitem), loglevel=LL.VERBOSE)
+                    handoff(rdx, qname, qitem)
+                elif (rval == 0 and not qitem.get('warning')):
                     logthis("QRunner: Completed job successfully.", prefix=qname, loglevel=LL.VERBOSE)
-                elif (rval == 1):
+                    jobstate(rdx, jid, state="done", finished=time.time(), expire=True)
+                elif (rval < 2):
                     logthis("QRunner: Job complete, but with warnings.", prefix=qname, loglevel=LL.WARNING)
-                else:
+                    jobstate(rdx, jid, state="warning", finished=time.time(), expire=True)
+                elif (rval == ctlvals['cancel']):
+                    logthis("QRunner: Job cancelled.", prefix=qname, loglevel=LL.WARNING)
+                    jobstate(rdx, jid, state="cancelled", finished=time.time(), expire=True)
+                elif (rval == ctlvals['pause']):
+                    logthis("QRunner: Job paused; moved to %s" % ("paused_"+qname), prefix=qname, loglevel=LL.WARNING)
+                    rdx.lpush("paused_"+qname, json.dumps(qitem))
+                    jobstate(rdx, jid, state="paused")
+                elif (rval == ctlvals['preempt']):
+                    logthis("QRunner: Job preempted; requeued.", prefix=qname, loglevel=LL.WARNING)
+                    qitem['preempted'] = qitem.get('preempted', 0) + 1
+                    push(rdx, qname, json.dumps(qitem), requeue=True)
+                    jobstate(rdx, jid, state="queued", preempted=qitem['preempted'])
+
+                # Record end-to-end time for finished jobs
+                if rval < 2 and not nextstage(qname):
+                    metrics.observe(rdx, 'total', time.time() - qitem.get('ts', time.time()))
+                    metrics.count(rdx, jobs=1)
+                elif rval >= 100:
                     logthis("QRunner: Job failed. rval =", prefix=qname, suffix=rval, loglevel=LL.ERROR)
+                    retry(qname, qitem, rval)
 
-                # Remove from work queue
-                rdx.rpop(wq)
+                # Finished jobs no longer accept coalesced enqueues; paused, preempted and handed-off jobs still exist
+                if (rval < 2 and not nextstage(qname)) or rval == ctlvals['cancel']:
+                    release(rdx, qname, qitem)
+                rdx.delete(ctlkey(qname, jid))
+
+                # Remove this job from the work queue and release the lease
+                ack(qname, wq, qiraw, jid, qmid)
 
             # Show wait message again
             logthis("-- QRunner: waiting; queue:", prefix=qname, suffix=qname, loglevel=LL.VERBOSE)
 
+        # Move any retries that are due back on to the main queue; in cluster mode, this is
+        # done by the leader for every node's copy of the queue
+        for pq in peers(qname):
+            promote(pq)
+
+        # Requeue jobs abandoned by other workers, and prune expired jobs from the job index.
+        # Stalled stream entries can only be claimed by a consumer of the same stream
+        if (time.time() - lastreap) > float(conf.queue['lease_ttl']):
+            if is_stream():
+                reap_stream(qname)
+            for pq in peers(qname):
+                if not is_stream(): reap(pq)
+                if pq == qname: prune(rdx)
+            lastreap = time.time()
+
         # Check if daddy is still alive; prevents this process from becoming a bastard child
-        if not master_alive():
+        if not supervisor.master_alive():
             logthis("QRunner: Master has terminated.", prefix=qname, loglevel=LL.WARNING)
             return
 
+        # Exit once idle if the autoscaler has retired this runner
+        if not qiraw and rdx.exists(retirekey(qname, wid)):
+            rdx.delete(retirekey(qname, wid))
+            if not rdx.llen(wq):
+                rdx.srem(workers_key(qname), wid)
+            logthis("QRunner: Retired by autoscaler.", prefix=qname, loglevel=LL.INFO)
+            return
+
 def cb_xfer(jdata):
     """
-    xfer queue handler
+    xfer queue handler; the transfer profile set by the move stage selects
+    the destination host
     """
-    global dlx, conf
+    global rdx, dlx, conf
 
     # get options from job request
     jid  = jdata['id']
     thash  = jdata['thash']
     opts = jdata['opts']
+    xconf = xfer_profile(conf, jdata.get('profile'))
 
     # Do some loggy stuff
     logthis("xfer: JobID %s / TorHash %s / Opts %s" % (jid, thash, json.dumps(opts)), loglevel=LL.VERBOSE)
 
     # get updated data from torrent client
+    tstart = time.time()
     tordata = dlx.getTorrent(thash)
+    metrics.observe(rdx, 'torrent_info', time.time() - tstart)
 
     if not tordata:
         logthis("!! Failed to retrieve torrent data corresponding to supplied hash. Job discarded.", loglevel=LL.ERROR)
         return 101
+    jobstate(rdx, jid, name=tordata['name'], size=tordata['total_size'])
 
     # establish SSH connection
-    rsh = rainshell(conf.xfer['hostname'], username=conf.xfer['user'],
-                    keyfile=conf.xfer['keyfile'], port=int(conf.xfer['port']))
+    tstart = time.time()
+    rsh = rainshell(xconf['hostname'], username=xconf['user'],
+                    keyfile=xconf['keyfile'], port=int(xconf['port']))
+    if xconf['hostname'] and not rsh.connected:
+        logthis("!! Failed to establish SSH connection to remote host", loglevel=LL.ERROR)
+        return 102
+    metrics.observe(rdx, 'ssh_connect', time.time() - tstart)
+
+    # report progress in the job state hash, and add newly-transferred bytes to the rolling counters;
+    # data that was already on the remote host counts towards progress, but not the transfer rate
+    lastbytes = [0]
+    def _jobprogress(xstats):
+        xelapsed = time.time() - xstats['started']
+        xbytes = xstats['gxfer'] + xstats['txfer']
+        xsent = xbytes - xstats['gskip']
+        jobstate(rdx, jid, bytes=xbytes, skipped=xstats['gskip'], total=xstats['gtotal'],
+                 rate=(xsent / xelapsed) if xelapsed > 0 else 0)
+        metrics.count(rdx, nbytes=xsent - lastbytes[0])
+        lastbytes[0] = xsent
+    rsh.progress_hook = _jobprogress
+    rsh.streams = int(xconf['streams'])
+    rsh.split_size = bwlimit.parse_rate(xconf['split_size'])
+    rsh.split_streams = int(xconf['split_streams'])
+    rsh.resume = bool(int(xconf['resume']))
+    rsh.resume_check = bwlimit.parse_rate(xconf['resume_check'])
+    rsh.mode = xconf['mode'].lower()
+    rsh.tar_threshold = bwlimit.parse_rate(xconf['tar_threshold'])
+    rsh.manifest = os.path.join(os.path.expanduser(xconf['manifest_dir']),
+                                "%s.%s.json" % (thash, jdata.get('profile') or 'default'))
+
+    # share the cluster-wide bandwidth budget, and apply any per-job cap
+    try:
+        rsh.throttle = bwlimit.Throttle(rdx, conf, (opts or {}).get('bwlimit'))
+    except ValueError as e:
+        logthis("!! Ignoring invalid per-job bandwidth limit:", suffix=e, loglevel=LL.WARNING)
+        rsh.throttle = bwlimit.Throttle(rdx, conf)
 
     # download
-    if conf.xfer['hostname']:
+    if xconf['hostname']:
         # send xfer start notification
         if conf.notify['user'] and conf.notify['hostname']:
             try:
@@ -205,23 +807,48 @@ def cb_xfer(jdata):
         logthis(">> Target path:", suffix=tgpath, loglevel=LL.INFO)
 
         logthis(">> Starting transfer to remote host:",
-                suffix="%s:%s" % (conf.xfer['hostname'], conf.xfer['basepath']), loglevel=LL.INFO)
+                suffix="%s:%s" % (xconf['hostname'], xconf['basepath']), loglevel=LL.INFO)
+        # stop between chunks if the job is cancelled, paused or preempted
+        rsh.control_hook = lambda: rdx.get(ctlkey(scope(xfer_queue(jdata.get('profile'))), jid))
         xstart = datetime.now()
-        rsh.xfer(tgpath, conf.xfer['basepath'])
+        try:
+            xrez = rsh.xfer(tgpath, xconf['basepath'])
+        except XferAborted as e:
+            xdone = rsh.xfer_stats['gxfer'] + rsh.xfer_stats['txfer']
+            jobstate(rdx, jid, bytes=xdone, files_done=rsh.xfer_stats['files_done'],
+                     stopped_at=rsh.xfer_stats['cur_file'] or '')
+            metrics.count(rdx, nbytes=xdone - rsh.xfer_stats['gskip'] - lastbytes[0])
+            # don't leave half-written files behind for cancelled jobs; paused and preempted
+            # jobs keep them, and pick up where they left off
+            if e.action == 'cancel':
+                rsh.drop_manifest()
+                for tpartial in e.partial:
+                    try:
+                        rsh.rsc.remove(tpartial)
+                    except Exception as ex:
+                        logthis("Failed to remove partial file:", prefix=tpartial, suffix=ex, loglevel=LL.WARNING)
+            jabber.send('set_status', { 'show': None, 'status': "Ready" })
+            rsh.close()
+            return ctlvals.get(e.action, 100)
         xstop = datetime.now()
+        for tstage, tsecs in rsh.timings.items():
+            metrics.observe(rdx, tstage, tsecs)
+        if xrez is False:
+            logthis("!! Transfer failed:", suffix=tordata['name'], loglevel=LL.ERROR)
+            rsh.close()
+            return 103
         logthis("** Transfer complete.", loglevel=LL.INFO)
+        # data that was already on the remote host doesn't count towards throughput
+        xsent = xrez - rsh.xfer_stats['gskip']
+        metrics.count(rdx, nbytes=xsent - lastbytes[0])
 
-        # send xfer complete notification
+        # record transfer results for the verify and notify stages
         xdelta = xstop - xstart
-        xdelta_str = re.sub(r'\.[0-9]+$', '', str(xdelta))
         tsize = tordata['total_size']
-        trate = float(tsize) / float(xdelta.seconds)
-        tsize_str = fmtsize(tsize)
-        trate_str = fmtsize(trate, rate=True)
-        trate_bstr = fmtsize(trate, rate=True, bits=True)
-        jabber.send('send_message', {'mto': conf.xmpp['sendto'],
-                    'mbody': "%s -- Transfer Complete (%s) -- Time Elapsed ( %s ) -- Rate [ %s | %s ]" %
-                    (tordata['name'], tsize_str, xdelta_str, trate_str, trate_bstr)})
+        trate = float(xsent) / max(xdelta.total_seconds(), 0.001)
+        jobstate(rdx, jid, bytes=tsize, skipped=rsh.xfer_stats['gskip'], total=tsize, rate=trate)
+        jdata['xfer'] = { 'name': tordata['name'], 'src': tgpath, 'dest': xconf['basepath'],
+                          'size': tsize, 'elapsed': xdelta.total_seconds(), 'rate': trate }
         jabber.send('set_status', { 'show': None, 'status': "Ready" })
 
     # done
@@ -229,16 +856,293 @@ def cb_xfer(jdata):
     return 0
 
 
-def enqueue(xredis, qname, thash, opts={}, jid=None, silent=False):
+def cb_move(jdata):
+    """
+    move queue handler; matches the torrent against the rulesets, and moves its
+    data to the `moveto` directory of the matching ruleset
+    """
+    global rdx, dlx, conf
+
+    jid = jdata['id']
+    thash = jdata['thash']
+    logthis("move: JobID %s / TorHash %s" % (jid, thash), loglevel=LL.VERBOSE)
+
+    tordata = dlx.getTorrent(thash)
+    if not tordata:
+        logthis("!! Failed to retrieve torrent data corresponding to supplied hash. Job discarded.", loglevel=LL.ERROR)
+        return 101
+    jobstate(rdx, jid, name=tordata['name'], size=tordata['total_size'])
+
+    # jobs queued from a completion event don't know their size yet; set it for the later stages
+    if not jdata.get('size'):
+        jdata['size'] = tordata['total_size']
+        jdata['score'] = score(jdata)
+
+    # find matching rules
+    rname, rset = ruleparser.match(tordata)
+    if rname:
+        logthis("++ Matched ruleset:\n", suffix=print_r(rset), loglevel=LL.VERBOSE)
+        jdata['ruleset'] = rname
+        if rset.get('xfer', None):
+            if rset['xfer'] in profiles(conf):
+                jdata['profile'] = rset['xfer']
+            else:
+                logthis("!! Undefined transfer profile; using default. profile =", prefix=rname,
+                        suffix=rset['xfer'], loglevel=LL.ERROR)
+    else:
+        logthis("!! No ruleset matched", loglevel=LL.WARNING)
+
+    if not rset.get('moveto', None):
+        return 0
+
+    # move to destination dir, then wait for the torrent client to finish moving the data
+    if not dlx.moveTorrent(thash, rset['moveto']):
+        logthis("!! Failed to move to", suffix=rset['moveto'], loglevel=LL.ERROR)
+        return 104
+
+    mdest = os.path.realpath(rset['moveto'])
+    tstop = time.time() + float(conf.queue['move_timeout'])
+    while time.time() < tstop:
+        tordata = dlx.getTorrent(thash)
+        if tordata and os.path.realpath(tordata['base_path']) == mdest and tordata.get('state') != "Moving":
+            logthis("** Moved to", suffix=rset['moveto'], loglevel=LL.INFO)
+            return 0
+        time.sleep(0.5)
+
+    logthis("!! Timed out waiting for torrent data to be moved to", suffix=rset['moveto'], loglevel=LL.ERROR)
+    return 104
+
+
+def cb_verify(jdata):
+    """
+    verify queue handler; checks that the transferred files exist on the remote
+    host with the same sizes as the local files
+    """
+    global rdx, conf
+
+    xconf = xfer_profile(conf, jdata.get('profile'))
+    if not xconf['hostname'] or not jdata.get('xfer'):
+        return 0
+
+    rsh = rainshell(xconf['hostname'], username=xconf['user'],
+                    keyfile=xconf['keyfile'], port=int(xconf['port']))
+    if not rsh.connected:
+        logthis("!! Failed to establish SSH connection to remote host", loglevel=LL.ERROR)
+        return 102
+
+    badfiles = rsh.verify(jdata['xfer']['src'], jdata['xfer']['dest'])
+    rsh.close()
+    if badfiles:
+        logthis("!! Verification failed for %d file(s):\n" % (len(badfiles)), suffix=print_r(badfiles),
+                loglevel=LL.ERROR)
+        return 105
+
+    logthis("** Verified transfer:", suffix=jdata['xfer']['name'], loglevel=LL.INFO)
+    return 0
+
+
+def cb_notify(jdata):
+    """
+    notify queue handler; sends transfer completion notifications
+    """
+    global conf
+
+    xinfo = jdata.get('xfer')
+    if not xinfo:
+        return 0
+
+    xdelta_str = re.sub(r'\.[0-9]+$', '', str(timedelta(seconds=xinfo['elapsed'])))
+    jabber.send('send_message', {'mto': conf.xmpp['sendto'],
+                'mbody': "%s -- Transfer Complete (%s) -- Time Elapsed ( %s ) -- Rate [ %s | %s ]" %
+                (xinfo['name'], fmtsize(xinfo['size']), xdelta_str, fmtsize(xinfo['rate'], rate=True),
+                 fmtsize(xinfo['rate'], rate=True, bits=True))})
+
+    if conf.notify['user'] and conf.notify['hostname']:
+        try:
+            libnotify_send(conf, "%s\n\nTransfer complete." % (xinfo['name']))
+        except Exception as e:
+            logthis("Failed to send libnotify message:", suffix=e, loglevel=LL.ERROR)
+
+    return 0
+
+
+def stage(qname):
+    """
+    returns the pipeline stage that queue `qname` belongs to; transfer profile
+    queues (xfer.<profile>) are part of the xfer stage
+    """
+    return unscope(qname).split('.', 1)[0]
+
+
+def scope(qname, xconfig=None):
+    """
+    returns the name of this node's copy of queue `qname` (<qname>@<node>) in
+    cluster mode, or `qname` otherwise
+    """
+    xconfig = xconfig or conf
+    if cluster.enabled(xconfig):
+        return "%s@%s" % (qname, cluster.node_name(xconfig))
+    return qname
+
+
+def unscope(qname):
+    """
+    returns the name of queue `qname` without its node suffix
+    """
+    return qname.split('@', 1)[0]
+
+
+def peers(qname):
+    """
+    returns the queues to run cluster-wide tasks (retry promotion, reaping) for: `qname`
+    outside of cluster mode; in cluster mode, every node's copy of `qname` if this node
+    is the leader, and none otherwise
+    """
+    global rdx, conf
+
+    if not cluster.enabled(conf):
+        return [ qname ]
+    if not cluster.is_leader(rdx, conf):
+        return []
+    return [ "%s@%s" % (unscope(qname), x) for x in cluster.members(rdx) ]
+
+
+def nextstage(qname, qitem=None):
+    """
+    returns the name of the queue for the pipeline stage following `qname`, or None.
+    Jobs with a transfer profile go to that profile's xfer queue
+    """
+    qstage = stage(qname)
+    if qstage in PIPELINE and PIPELINE.index(qstage) + 1 < len(PIPELINE):
+        nq = PIPELINE[PIPELINE.index(qstage) + 1]
+        if nq == 'xfer' and qitem:
+            nq = xfer_queue(qitem.get('profile'))
+        # stay on the same node
+        return nq + qname[len(unscope(qname)):]
+    return None
+
+
+def handoff(xredis, qname, qitem):
+    """
+    pass job `qitem`, which has completed stage `qname`, on to the next stage's queue
+    """
+    nq = nextstage(qname, qitem)
+    qitem['handoff'] = time.time()
+    qitem.pop('retry_at', None)
+    qitem.pop('attempts', None)
+    push(xredis, nq, json.dumps(qitem))
+    jobstate(xredis, qitem['id'], state="queued", queue=nq, attempts=0)
+
+    # the job's transfer profile is only known once it has been through the move stage
+    if stage(nq) == 'xfer':
+        preempt(xredis, nq, qitem)
+    return nq
+
+
+def profiles(xconfig):
+    """
+    returns the names of all transfer profiles ([xfer:<name>] sections)
+    """
+    return [ x.split(':', 1)[1] for x in xconfig.keys() if x.startswith('xfer:') ]
+
+
+def xfer_profile(xconfig, pname=None):
+    """
+    returns a dict of transfer settings for profile `pname`; options that are not
+    set in the [xfer:<pname>] section are inherited from [xfer]. Returns the [xfer]
+    settings if `pname` is not set
+    """
+    pconf = { k: xconfig.xfer[k] for k in xconfig.xfer.keys() }
+    pconf['workers'] = 1
+    if pname:
+        psec = xconfig['xfer:'+pname]
+        pconf.update({ k: psec[k] for k in psec.keys() })
+    return pconf
+
+
+def xfer_queue(pname=None):
+    """
+    returns the name of the xfer queue for transfer profile `pname`
+    """
+    return "xfer.%s" % (pname) if pname else "xfer"
+
+
+def queues(xconfig):
+    """
+    returns the names of all of this node's queues: one for each pipeline stage,
+    plus one xfer queue for each transfer profile
+    """
+    qlist = []
+    for qstage in PIPELINE:
+        qlist.append(scope(qstage, xconfig))
+        if qstage == 'xfer':
+            qlist += [ scope(xfer_queue(x), xconfig) for x in sorted(profiles(xconfig)) ]
+    return qlist
+
+
+def load(xredis, xconfig):
+    """
+    returns the number of queued and running jobs, and the number of queue runners,
+    for each of this node's queues; published by the cluster heartbeat
+    """
+    global pool
+    return { unscope(x): { 'queued': queue_len(xredis, x), 'active': len(active_items(xredis, x)),
+                           'workers': len(pool.get(x, ())) } for x in queues(xconfig) }
+
+
+def idle(xredis, xconfig, node):
+    """
+    returns True if node `node` has no queued, running or delayed jobs in any of its
+    queues; used by the cluster leader to decide when a node that has gone away can be
+    removed from the cluster
+    """
+    for tq in queues(xconfig):
+        nq = "%s@%s" % (unscope(tq), node)
+        if queue_len(xredis, nq) or active_items(xredis, nq) or xredis.zcard("delayed_"+nq):
+            return False
+    return True
+
+def enqueue(xredis, qname, thash, opts={}, jid=None, silent=False, size=None):
     """
     enqueue a task on the specified queue
+    `size` is the total size of the torrent, used for scheduling in priority mode
     """
+    global conf
+
     # generate a job ID from the current time
     if not jid:
         jid = str(time.time()).replace(".", "")
 
-    # JSON-encode and LPUSH on to the selected queue
-    xredis.lpush("queue_"+qname, json.dumps({'id': jid, 'thash': thash, 'opts': opts }))
+    # if this torrent is already queued or active, merge into the existing job
+    ejid = dedupe(xredis, qname, thash, jid, opts)
+    if ejid:
+        xredis.hincrby("job:"+ejid, 'coalesced', 1)
+        if not silent:
+            logthis("Coalesced enqueue into existing job# %s in queue:" % (ejid), suffix=qname, loglevel=LL.VERBOSE)
+        return ejid
+
+    # build job data; the score is only used by the priority scheduler, but is always
+    # stored so that jobs keep their place if the scheduler is changed
+    try:
+        jprio = int((opts or {}).get('priority', 0))
+    except (TypeError, ValueError):
+        jprio = 0
+    qitem = {'id': jid, 'thash': thash, 'opts': opts, 'size': size, 'priority': jprio, 'ts': time.time(),
+             'origin': qname}
+    qitem['score'] = score(qitem)
+
+    # create job state hash, and add it to the job index
+    jobstate(xredis, jid, id=jid, thash=thash, queue=qname, state="queued", enqueued=qitem['ts'],
+             size=size or 0, bytes=0, rate=0, attempts=0, coalesced=0, error="")
+    xredis.zadd("jobs", jid, qitem['ts'])
+
+    # JSON-encode and push on to the selected queue
+    push(xredis, qname, json.dumps(qitem))
+
+    # make room for high-priority jobs when all runners are busy; jobs entering the
+    # pipeline are checked when they are handed off to their xfer queue
+    if stage(qname) == 'xfer':
+        preempt(xredis, qname, qitem)
 
     if not silent:
         logthis("Enqueued job# %s in queue:" % (jid), suffix=qname, loglevel=LL.VERBOSE)
@@ -246,11 +1150,497 @@ def enqueue(xredis, qname, thash, opts={}, jid=None, silent=False):
     return jid
 
 
-def master_alive():
-    global dadpid
+def dedupe(xredis, qname, thash, jid, opts):
+    """
+    check the idempotency index for an existing job for torrent `thash`;
+    if there is one, merge `opts` into it and return its job ID. Otherwise,
+    register `jid` as the job for this torrent and return None
+    """
+    global conf
+
+    ittl = int(conf.queue['dedupe_ttl'])
+    ikey = "jobidx_%s:%s" % (qname, thash)
+    if xredis.set(ikey, jid, nx=True, ex=ittl):
+        return None
+
+    ejid = xredis.get(ikey)
+    if not ejid:
+        # index entry expired between SET and GET; don't bother trying again
+        return None
+
+    # merge options into the existing job
+    mkey = "jobmerge_%s:%s" % (qname, ejid)
     try:
-        os.kill(dadpid, 0)
-    except OSError:
-        return False
-    else:
+        mdata = json.loads(xredis.get(mkey) or '{}')
+    except Exception as e:
+        mdata = {}
+    if isinstance(opts, dict):
+        mopts = mdata.get('opts') or {}
+        mopts.update(opts)
+        mdata['opts'] = mopts
+    mdata['count'] = mdata.get('count', 0) + 1
+    xredis.setex(mkey, json.dumps(mdata), ittl)
+
+    return ejid
+
+
+def coalesce(xredis, qname, qitem):
+    """
+    apply options merged from coalesced enqueues to job `qitem`, and refresh its index entry
+    """
+    global conf
+
+    # the index entry belongs to the queue the job was originally enqueued on
+    qname = qitem.get('origin', qname)
+    xredis.expire("jobidx_%s:%s" % (qname, qitem.get('thash')), int(conf.queue['dedupe_ttl']))
+    mdata = merged(xredis, qname, qitem.get('id'))
+    if mdata:
+        if isinstance(mdata.get('opts'), dict):
+            if not isinstance(qitem.get('opts'), dict):
+                qitem['opts'] = {}
+            qitem['opts'].update(mdata['opts'])
+        qitem['coalesced'] = mdata.get('count', 0)
+    return qitem
+
+
+def merged(xredis, qname, jid):
+    """
+    returns merged options and count of coalesced enqueues for job `jid`, or None
+    """
+    try:
+        return json.loads(xredis.get("jobmerge_%s:%s" % (qname, jid)) or 'null')
+    except Exception as e:
+        return None
+
+
+def release(xredis, qname, qitem):
+    """
+    remove a finished job from the idempotency index
+    """
+    qname = qitem.get('origin', qname)
+    ikey = "jobidx_%s:%s" % (qname, qitem.get('thash'))
+    if xredis.get(ikey) == qitem.get('id'):
+        xredis.delete(ikey)
+    xredis.delete("jobmerge_%s:%s" % (qname, qitem.get('id')))
+
+
+def ctlkey(qname, jid):
+    """
+    returns the name of the control key for job `jid`
+    """
+    return "jobctl_%s:%s" % (qname, jid)
+
+
+def unqueue(xredis, qname, jid):
+    """
+    remove job `jid` from the main queue or the delayed list, if it is waiting there;
+    returns its job data, or None
+    """
+    for traw in queue_items(xredis, qname) + xredis.zrange("delayed_"+qname, 0, -1):
+        try:
+            titem = json.loads(traw)
+        except Exception as e:
+            continue
+        if titem.get('id') != jid:
+            continue
+
+        # only remove the job if it wasn't picked up by a runner in the meantime
+        if is_stream():
+            removed = False
+            pmap = pending(xredis, qname)
+            for mid, mf in xredis.xrange(stream_key(qname)):
+                if mf and mf['job'] == traw and mid not in pmap:
+                    removed = xredis.xdel(stream_key(qname), mid)
+                    break
+        elif is_priority():
+            removed = xredis.zrem(queue_key(qname), traw)
+        else:
+            removed = xredis.lrem(queue_key(qname), 1, traw)
+        if removed or xredis.zrem("delayed_"+qname, traw):
+            return titem
+
+    return None
+
+
+def unpause(xredis, qname, jid):
+    """
+    remove job `jid` from the paused list; returns its job data, or None
+    """
+    for traw in xredis.lrange("paused_"+qname, 0, -1):
+        try:
+            titem = json.loads(traw)
+        except Exception as e:
+            continue
+        if titem.get('id') == jid and xredis.lrem("paused_"+qname, 1, traw):
+            return titem
+    return None
+
+
+def control(xredis, qname, jid, action):
+    """
+    cancel or pause job `jid`. Waiting and paused jobs are handled immediately; for
+    running transfers, the control key is set, and the runner stops the transfer the
+    next time it checks. Returns the resulting state ('cancelled', 'paused' or
+    'stopping'), 'not_stoppable' if the job is running in a stage other than xfer,
+    or None if the job is not waiting, paused or running
+    """
+    global conf
+
+    titem = unqueue(xredis, qname, jid)
+    if titem:
+        if action == 'cancel':
+            release(xredis, qname, titem)
+            jobstate(xredis, jid, state="cancelled", finished=time.time(), expire=True)
+            return "cancelled"
+        else:
+            xredis.lpush("paused_"+qname, json.dumps(titem))
+            jobstate(xredis, jid, state="paused")
+            return "paused"
+
+    jstate = (jobinfo(xredis, jid) or {}).get('state')
+    if jstate == "paused":
+        if action == 'pause':
+            return "paused"
+        titem = unpause(xredis, qname, jid)
+        if titem:
+            release(xredis, qname, titem)
+            jobstate(xredis, jid, state="cancelled", finished=time.time(), expire=True)
+            return "cancelled"
+
+    if jstate == "active":
+        # only transfers check the control key; the other stages run to completion
+        if stage(qname) != 'xfer':
+            return "not_stoppable"
+        xredis.setex(ctlkey(qname, jid), action, int(conf.queue['lease_ttl']) * 10)
+        logthis("Requested %s of running job:" % (action), prefix=qname, suffix=jid, loglevel=LL.VERBOSE)
+        return "stopping"
+
+    return None
+
+
+def resume(xredis, qname, jid):
+    """
+    move paused job `jid` back on to the main queue; returns True if the job was requeued
+    """
+    titem = unpause(xredis, qname, jid)
+    if titem:
+        push(xredis, qname, json.dumps(titem))
+        jobstate(xredis, jid, state="queued")
         return True
+    return False
+
+
+def preempt(xredis, qname, qitem):
+    """
+    priority mode: if `qitem` has at least `preempt_priority`, every queue runner for
+    xfer queue `qname` is busy, and the pool can't grow, ask the running job with the
+    lowest priority below that of `qitem` to stop and requeue itself. The pool's
+    maximum size is taken from the config, so this may be called from any process.
+    Returns the ID of the preempted job, or None
+    """
+    global conf
+
+    if not is_priority() or int(conf.queue['preempt_priority']) <= 0 or \
+       qitem.get('priority', 0) < int(conf.queue['preempt_priority']):
+        return None
+
+    # the autoscaler only resizes the default xfer pool; until it is at its maximum,
+    # it will start another runner instead
+    pmax = pool_size(conf, qname)
+    if unscope(qname) == 'xfer':
+        pmax = max(pmax, int(conf.queue['workers_max']))
+    alist = active_items(xredis, qname)
+    if len(alist) < pmax:
+        return None
+
+    victim = None
+    for traw, twid in alist:
+        try:
+            titem = json.loads(traw)
+        except Exception as e:
+            continue
+        if titem.get('priority', 0) >= qitem.get('priority', 0) or xredis.exists(ctlkey(qname, titem.get('id'))):
+            continue
+        if victim is None or titem.get('priority', 0) < victim.get('priority', 0):
+            victim = titem
+
+    if victim:
+        xredis.setex(ctlkey(qname, victim['id']), 'preempt', int(conf.queue['lease_ttl']) * 10)
+        logthis("Preempting job %s (priority %d) for job %s (priority %d)" %
+                (victim['id'], victim.get('priority', 0), qitem['id'], qitem.get('priority', 0)),
+                prefix=qname, loglevel=LL.INFO)
+        return victim['id']
+    return None
+
+
+def jobstate(xredis, jid, expire=False, **fields):
+    """
+    update fields in the state hash (job:<id>) for job `jid`; when `expire` is set,
+    the hash expires after `job_ttl` seconds
+    """
+    global conf
+
+    if fields:
+        xredis.hset("job:"+jid, { k: ('' if v is None else v) for k, v in fields.items() })
+    if expire:
+        xredis.expire("job:"+jid, int(conf.queue['job_ttl']))
+
+
+def jobinfo(xredis, jid=None, jraw=None):
+    """
+    returns the state hash for job `jid` with numeric fields converted, or None if the
+    job does not exist; a hash that has already been fetched can be passed as `jraw`
+    """
+    if jraw is None:
+        jraw = xredis.hgetall("job:"+jid)
+    if not jraw:
+        return None
+
+    jout = dict(jraw)
+    for tk in ('enqueued', 'started', 'finished', 'size', 'bytes', 'skipped', 'total', 'rate', 'retry_at'):
+        if jout.get(tk, '') != '':
+            jout[tk] = float(jout[tk])
+    for tk in ('attempts', 'coalesced', 'preempted', 'files_done'):
+        if jout.get(tk, '') != '':
+            jout[tk] = int(jout[tk])
+    return jout
+
+
+def joblist(xredis, offset=0, limit=50):
+    """
+    returns a page of job state hashes from the job index, newest first
+    """
+    jids = xredis.zrevrange("jobs", offset, offset + limit - 1)
+    jlist = []
+    for jid, jraw in zip(jids, xredis.hgetall_multi([ "job:"+x for x in jids ])):
+        jinfo = jobinfo(xredis, jraw=jraw)
+        if jinfo:
+            jlist.append(jinfo)
+    return jlist
+
+
+def prune(xredis):
+    """
+    remove jobs older than `job_ttl` from the job index
+    """
+    global conf
+    return xredis.zremrangebyscore("jobs", 0, time.time() - float(conf.queue['job_ttl']))
+
+
+def errstr(rval):
+    """
+    returns a description for a job handler return value
+    """
+    return rvals.get(rval, "Job failed (rval = %s)" % (rval))
+
+
+def score(qitem):
+    """
+    calculate priority scheduler score for a job; jobs with the lowest score are run first.
+    The score is the enqueue time, plus a penalty based on job size (shortest-job-first),
+    minus a bonus for explicit priority. The size penalty is capped at `max_penalty` seconds,
+    so that large jobs are not starved; once a large job has waited that long, it will be
+    ahead of any small job enqueued after it
+    """
+    global conf
+
+    penalty = 0.0
+    if qitem.get('size') and float(conf.queue['sjf_rate']) > 0:
+        penalty = min(float(qitem['size']) / float(conf.queue['sjf_rate']), float(conf.queue['max_penalty']))
+
+    return qitem.get('ts', time.time()) + penalty - (qitem.get('priority', 0) * float(conf.queue['priority_step']))
+
+
+def is_priority():
+    """
+    returns True if the priority scheduler is enabled; the stream backend
+    always runs jobs in FIFO order
+    """
+    global conf
+    return conf.queue['scheduler'].lower() == 'priority' and not is_stream()
+
+
+def backend_mode():
+    """
+    returns the queue mode used by server-side scripts: 'fifo', 'priority', or 'stream'
+    """
+    if is_stream():
+        return 'stream'
+    elif is_priority():
+        return 'priority'
+    else:
+        return 'fifo'
+
+
+def is_stream():
+    """
+    returns True if the Redis Streams backend is enabled
+    """
+    global conf
+    return conf.queue['backend'].lower() == 'stream'
+
+
+def stream_key(qname):
+    """
+    returns the name of the stream used by the stream backend
+    """
+    return "stream_"+qname
+
+
+def consumer_name(wid):
+    """
+    returns the consumer group member name for worker `wid`; this is stable
+    across restarts, so that a restarted worker can pick up its own pending entries
+    """
+    global conf
+    return "%s:%d" % (conf.queue['consumer'] or socket.gethostname(), wid)
+
+
+def stream_setup(qname):
+    """
+    create the stream and consumer group, if they do not already exist
+    """
+    global rdx, conf
+    try:
+        rdx.xgroup_create(stream_key(qname), conf.queue['group'], mid='0', mkstream=True)
+        logthis("Created consumer group:", prefix=qname, suffix=conf.queue['group'], loglevel=LL.VERBOSE)
+    except db.xredis.exceptions.ResponseError as e:
+        # BUSYGROUP; group already exists
+        pass
+
+
+def queue_key(qname):
+    """
+    returns the name of the main queue for the configured scheduler; the FIFO scheduler
+    uses a list (queue_*), while the priority scheduler uses a sorted set (pqueue_*), and
+    the stream backend uses a stream (stream_*)
+    """
+    if is_stream():
+        return stream_key(qname)
+    elif is_priority():
+        return "pqueue_"+qname
+    else:
+        return "queue_"+qname
+
+
+def push(xredis, qname, qiraw, requeue=False):
+    """
+    push raw job data `qiraw` on to the main queue; when `requeue` is True, the job
+    is placed at the head of a FIFO queue, so that it is the next to run
+    """
+    if is_stream():
+        return xredis.xadd(stream_key(qname), {'job': qiraw})
+    elif is_priority():
+        try:
+            qitem = json.loads(qiraw)
+            jscore = qitem.get('score', None)
+            if jscore is None:
+                jscore = score(qitem)
+        except Exception as e:
+            jscore = time.time()
+        return xredis.zadd(queue_key(qname), qiraw, jscore)
+    elif requeue:
+        return xredis.rpush(queue_key(qname), qiraw)
+    else:
+        return xredis.lpush(queue_key(qname), qiraw)
+
+
+def dequeue(xredis, qname, wq, timeout=0):
+    """
+    pop the next job from the main queue and push it on to work list `wq`,
+    blocking for up to `timeout` seconds; returns a tuple of (raw job data, stream entry ID),
+    or (None, None). The entry ID is only set with the stream backend, where `wq` is the
+    name of the consumer
+    """
+    global conf, backlog
+
+    if is_stream():
+        sxk = stream_key(qname)
+        # read entries already pending for this consumer first (crash recovery, or claimed by the reaper)
+        while backlog:
+            srez = xredis.xreadgroup(conf.queue['group'], wq, {sxk: '0'}, count=1)
+            if not srez or not srez[0][1]:
+                backlog = False
+                break
+            mid, mfields = srez[0][1][0]
+            if mfields:
+                return (mfields['job'], mid)
+            # entry was deleted from the stream while pending; drop it from the PEL
+            xredis.xack(sxk, conf.queue['group'], mid)
+
+        srez = xredis.xreadgroup(conf.queue['group'], wq, {sxk: '>'}, count=1, block=int(timeout * 1000))
+        if not srez or not srez[0][1]:
+            return (None, None)
+        mid, mfields = srez[0][1][0]
+        return (mfields['job'], mid)
+    elif is_priority():
+        # pop and push in one script, so that a runner dying in between can't lose the job
+        tend = time.time() + timeout
+        while True:
+            qiraw = xredis.runscript('zpopwork', keys=[queue_key(qname), wq])
+            if qiraw:
+                return (qiraw, None)
+            if timeout and time.time() >= tend:
+                return (None, None)
+            time.sleep(ZPOP_INTERVAL)
+    else:
+        return (xredis.brpoplpush(queue_key(qname), wq, timeout), None)
+
+
+def pending(xredis, qname):
+    """
+    stream backend: returns a dict of entry ID -> consumer name for all
+    entries that have been delivered but not yet acknowledged
+    """
+    global conf
+    try:
+        plist = xredis.xpending_range(stream_key(qname), conf.queue['group'], '-', '+', 1000000)
+    except db.xredis.exceptions.ResponseError as e:
+        # NOGROUP; no runners have been started yet
+        plist = []
+    return { p['message_id']: p['consumer'] for p in plist }
+
+
+def queue_len(xredis, qname):
+    """
+    returns the number of jobs waiting in the main queue
+    """
+    if is_stream():
+        return max(0, xredis.xlen(stream_key(qname)) - len(pending(xredis, qname)))
+    elif is_priority():
+        return xredis.zcard(queue_key(qname))
+    else:
+        return xredis.llen(queue_key(qname))
+
+
+def queue_items(xredis, qname):
+    """
+    returns raw job data for all waiting jobs, in the order they will be run
+    """
+    if is_stream():
+        pmap = pending(xredis, qname)
+        return [ mf['job'] for mid, mf in xredis.xrange(stream_key(qname)) if mid not in pmap and mf ]
+    elif is_priority():
+        return xredis.zrange(queue_key(qname), 0, -1)
+    else:
+        return list(reversed(xredis.lrange(queue_key(qname), 0, -1)))
+
+
+def active_items(xredis, qname):
+    """
+    returns a list of (raw job data, worker) tuples for all jobs that are currently
+    being run. `worker` is the worker number for the list backend, or the consumer
+    name for the stream backend
+    """
+    alist = []
+    if is_stream():
+        pmap = pending(xredis, qname)
+        for mid, mf in xredis.xrange(stream_key(qname)):
+            if mid in pmap and mf:
+                alist.append((mf['job'], pmap[mid]))
+    else:
+        for twid in sorted([ int(x) for x in xredis.smembers(workers_key(qname)) ]):
+            for traw in xredis.lrange(workq(qname, twid), 0, -1):
+                alist.append((traw, twid))
+    return alist
+
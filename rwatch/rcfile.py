@@ -23,9 +23,6 @@ from rwatch import *
 from rwatch.logthis import *
 from rwatch.util import *
 
-# RCfile list
-rcfiles = [ './rainwatch.conf', '~/.rainwatch/rainwatch.conf', '~/.rainwatch', '/etc/rainwatch.conf' ]
-
 # Parser object
 rcpar = None
 
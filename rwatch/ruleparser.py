@@ -66,6 +66,9 @@ def parse(xconfig):
                 tset['moveto'] = sv
                 if not os.path.isdir(sv):
                     logthis("moveto path does not exist:", prefix=k, suffix=sv, loglevel=LL.VERBOSE)
+            elif sk == 'xfer':
+                # transfer profile directive
+                tset['xfer'] = sv
             elif sk == 'type':
                 # type attribute
                 tset['type'] = sv.lower()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.spool
+Rainwatch > Local write-ahead spool for hook enqueues
+
+The completion hook appends a line to a local spool file, which the daemon
+drains into the queue. The hook never waits on Redis or the daemon, and
+completions that arrive while either is down are not lost. The daemon also
+accepts completions on a Unix socket (see rwatch.hook), and spools them itself
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import os
+import time
+import json
+import fcntl
+import socket
+import threading
+import socketserver
+
+from rwatch.logthis import *
+from rwatch import supervisor
+
+# Set to wake the drain thread as soon as a completion arrives on the socket
+wakeup = threading.Event()
+
+
+def spool_path(xconfig):
+    """
+    returns the full path to the spool file
+    """
+    return os.path.realpath(os.path.expanduser(xconfig.core['spool']))
+
+
+def append(xconfig, thash, opts=False):
+    """
+    append a completion to the spool; called from the hook
+    """
+    spath = spool_path(xconfig)
+    if not os.path.isdir(os.path.dirname(spath)):
+        os.makedirs(os.path.dirname(spath), 0o700)
+    sline = (json.dumps({ 'thash': thash, 'opts': opts, 'ts': time.time() }) + "\n").encode('utf-8')
+
+    # a child forked while the lock is held would keep it held (see supervisor.nofork)
+    while True:
+        with supervisor.nofork():
+            fd = os.open(spath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # the daemon may have renamed the file to drain it while we were waiting
+                # for the lock; if so, start over with a new spool file
+                try:
+                    if os.fstat(fd).st_ino != os.stat(spath).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                os.write(fd, sline)
+                if int(xconfig.core['spool_fsync']):
+                    os.fsync(fd)
+                return True
+            finally:
+                os.close(fd)
+
+
+def start(xconfig, handler):
+    """
+    start the spool drain thread; `handler(thash, opts)` is called for each spooled
+    completion, and should raise an exception if it could not be queued
+    """
+    dthread = threading.Thread(target=drainer, args=(xconfig, handler), name="spool", daemon=True)
+    dthread.start()
+    logthis("Draining spool:", suffix=spool_path(xconfig), loglevel=LL.VERBOSE)
+
+
+def drainer(xconfig, handler):
+    """
+    spool drain thread
+    """
+    while True:
+        try:
+            drain(xconfig, handler)
+        except Exception as e:
+            logexc(e, "!! Failed to drain spool")
+        wakeup.wait(float(xconfig.core['spool_interval']))
+        wakeup.clear()
+
+
+def drain(xconfig, handler):
+    """
+    move the spool aside and pass its entries to `handler`; entries for the same torrent
+    are merged. Entries that could not be handled are kept, and retried on the next pass.
+    Returns the number of entries handled
+    """
+    spath = spool_path(xconfig)
+    dpath = spath + ".draining"
+
+    # entries left over from a previous pass are handled first. Otherwise, the spool is
+    # renamed while holding its lock, so that no hook is part-way through appending to it
+    if not os.path.exists(dpath):
+        with supervisor.nofork():
+            try:
+                fd = os.open(spath, os.O_RDONLY)
+            except FileNotFoundError:
+                return 0
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_size == 0:
+                    return 0
+                os.rename(spath, dpath)
+            finally:
+                os.close(fd)
+
+    with open(dpath, 'r', encoding='utf-8') as f:
+        slines = f.readlines()
+
+    # merge entries for the same torrent, keeping the order of first appearance
+    entries = {}
+    for tline in slines:
+        try:
+            tent = json.loads(tline)
+        except Exception as e:
+            # a torn write from a hook that was killed part-way through
+            logthis("!! Discarding malformed spool entry:", suffix=tline.strip(), loglevel=LL.ERROR)
+            continue
+        if tent['thash'] in entries:
+            if isinstance(tent.get('opts'), dict):
+                mopts = entries[tent['thash']]['opts'] if isinstance(entries[tent['thash']]['opts'], dict) else {}
+                mopts.update(tent['opts'])
+                entries[tent['thash']]['opts'] = mopts
+        else:
+            entries[tent['thash']] = tent
+
+    handled = 0
+    remaining = list(entries.values())
+    try:
+        while remaining:
+            handler(remaining[0]['thash'], remaining[0].get('opts', False))
+            remaining.pop(0)
+            handled += 1
+    finally:
+        if remaining:
+            # rewrite the leftovers atomically; they are retried on the next pass
+            with open(dpath + ".tmp", 'w', encoding='utf-8') as f:
+                f.write(''.join([ json.dumps(x) + "\n" for x in remaining ]))
+            os.rename(dpath + ".tmp", dpath)
+        else:
+            os.unlink(dpath)
+
+    if handled:
+        logthis(">> Queued completions from spool:", suffix=handled, loglevel=LL.VERBOSE)
+    return handled
+
+
+class HookHandler(socketserver.StreamRequestHandler):
+    """
+    handles one hook connection; each line is either a JSON object with `thash`
+    and optional `opts`, or a bare torrent hash. Each completion is spooled before
+    it is acknowledged with "OK", so it survives a daemon restart
+    """
+    def handle(self):
+        for tline in self.rfile:
+            tline = tline.decode('utf-8', 'replace').strip()
+            if not tline:
+                continue
+            try:
+                if tline.startswith('{'):
+                    tent = json.loads(tline)
+                else:
+                    tent = { 'thash': tline }
+                if not tent.get('thash'):
+                    raise ValueError("no torrent hash given")
+                append(self.server.xconfig, tent['thash'], tent.get('opts', False))
+                wakeup.set()
+                logthis("Received completion on hook socket:", suffix=tent['thash'], loglevel=LL.DEBUG)
+                self.wfile.write(b"OK\n")
+            except Exception as e:
+                logexc(e, "!! Failed to spool completion from hook socket")
+                self.wfile.write(("ERR %s\n" % (e)).encode('utf-8'))
+
+
+class HookServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def sock_path(xconfig):
+    """
+    returns the full path to the hook socket
+    """
+    return os.path.realpath(os.path.expanduser(xconfig.srv['socket']))
+
+
+def listen(xconfig):
+    """
+    start the hook socket listener thread. The socket is only accessible to the
+    user running the daemon
+    """
+    spath = sock_path(xconfig)
+    if not os.path.isdir(os.path.dirname(spath)):
+        os.makedirs(os.path.dirname(spath), 0o700)
+
+    # remove a stale socket left by a previous daemon, unless it is still listening
+    if os.path.exists(spath):
+        tsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            tsock.connect(spath)
+            logthis("!! Hook socket is already in use by another daemon:", suffix=spath, loglevel=LL.ERROR)
+            return None
+        except socket.error:
+            os.unlink(spath)
+        finally:
+            tsock.close()
+
+    oldmask = os.umask(0o177)
+    try:
+        hsrv = HookServer(spath, HookHandler)
+    finally:
+        os.umask(oldmask)
+    hsrv.xconfig = xconfig
+
+    lthread = threading.Thread(target=hsrv.serve_forever, name="hooksock", daemon=True)
+    lthread.start()
+    logthis("Listening for hooks on socket:", suffix=spath, loglevel=LL.VERBOSE)
+    return hsrv
@@ -15,14 +15,139 @@ https://ycnrg.org/
 """
 
 import os
+import json
 import time
+import shlex
+import hashlib
+import tarfile
+import threading
+import collections
 
 import paramiko
+from paramiko.sftp import CMD_WRITE, CMD_STATUS, SFTPError, int64
 
 from rwatch.logthis import *
 from rwatch.util import *
 from rwatch import jabber
 
+# Suffix for files being written in ranges; they are renamed once all ranges are complete
+PART_SUFFIX = ".rwpart"
+
+# Size of the blocks read from local files; progress is reported once per block
+WRITE_BLOCK = 262144
+
+# Size of each SFTP write request, and how many may be awaiting acknowledgement at once
+WRITE_REQUEST = 32768
+WRITE_INFLIGHT = 128
+
+# Receive window and maximum packet size for SFTP channels
+SFTP_WINDOW = 16777216
+SFTP_MAX_PACKET = 262144
+
+# Alignment of range boundaries
+RANGE_ALIGN = 1048576
+
+# How often range writers checkpoint their progress to the manifest, in seconds
+CHECKPOINT_INTERVAL = 5.0
+
+# Buffer size for the tar stream; data is sent over the channel in blocks of this size
+TAR_BUFSIZE = 262144
+
+
+class XferAborted(Exception):
+    """
+    raised from the progress callback to stop a transfer; `action` is the control
+    action that was requested, and `partial` is a list of the remote paths of the
+    files that were being written
+    """
+    def __init__(self, action, partial=None):
+        super(XferAborted, self).__init__("Transfer aborted: %s" % (action))
+        self.action = action
+        self.partial = partial or []
+
+
+class _SFTPWriter(object):
+    """
+    sends pipelined writes for an open SFTPFile, with up to WRITE_INFLIGHT requests
+    awaiting acknowledgement. Acknowledgements are collected as they arrive; SFTPFile's
+    own pipelined mode waits for all of them at once, which leaves the link idle for a
+    round trip every hundred or so writes. This uses SFTPClient's internal request
+    methods; if a Paramiko version doesn't have them, SFTPFile's pipelined writes
+    are used instead
+    """
+    def __init__(self, rf):
+        self.rf = rf
+        self.sftp = rf.sftp
+        self.reqs = collections.deque()
+        self.native = hasattr(self.sftp, '_async_request') and hasattr(self.sftp, '_read_response')
+        if not self.native:
+            rf.set_pipelined(True)
+
+    def write(self, offset, data):
+        """
+        write `data` (bytes or a memoryview) at `offset`; the data is copied into the
+        request messages before this returns, so the caller may reuse its buffer
+        """
+        if not self.native:
+            if self.rf.tell() != offset:
+                self.rf.seek(offset)
+            self.rf.write(data)
+            return
+        for i in range(0, len(data), WRITE_REQUEST):
+            self.reqs.append(self.sftp._async_request(type(None), CMD_WRITE, self.rf.handle, int64(offset + i),
+                                                      data[i:i+WRITE_REQUEST]))
+            while self.reqs and (len(self.reqs) >= WRITE_INFLIGHT or self.sftp.sock.recv_ready()):
+                self._reap()
+
+    def flush(self):
+        """
+        wait until every write has been acknowledged; a failed write raises IOError
+        """
+        if not self.native:
+            # the server handles requests in order, so once the stat is answered,
+            # every write before it has been applied
+            self.rf.flush()
+            self.rf.stat()
+            return
+        while self.reqs:
+            self._reap()
+
+    def _reap(self):
+        t, msg = self.sftp._read_response(self.reqs.popleft())
+        if t != CMD_STATUS:
+            raise SFTPError("Expected status")
+
+
+class _ChannelWriter(object):
+    """
+    file-like wrapper that sends everything written to it over an SSH channel; once
+    `dropped` is set, further writes are discarded
+    """
+    def __init__(self, chan):
+        self.chan = chan
+        self.dropped = False
+
+    def write(self, data):
+        if not self.dropped:
+            self.chan.sendall(data)
+        return len(data)
+
+
+class _ProgressReader(object):
+    """
+    file-like wrapper that calls `callback` with the number of bytes read so far
+    """
+    def __init__(self, fobj, callback):
+        self.fobj = fobj
+        self.callback = callback
+        self.done = 0
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.done += len(data)
+        self.callback(self.done)
+        return data
+
 
 class rainshell(paramiko.client.SSHClient):
     """
@@ -31,9 +156,22 @@ class rainshell(paramiko.client.SSHClient):
     rsc = None
     connected = False
     jbx = None
+    progress_hook = None
+    throttle = None
+    control_hook = None
+    timings = {}
+    streams = 1
+    split_size = 0
+    split_streams = 1
+    resume = True
+    resume_check = 0
+    manifest = None
+    mode = 'sftp'
+    tar_threshold = 0
+    _tar_ok = None
 
     xfer_stats = {'xname': None, 'files_tot': 0, 'files_done': 0, 'cur_file': None,
-                  'gtotal': 0, 'gxfer': 0, 'ttotal': 0, 'txfer': 0, 'last_update': 0}
+                  'gtotal': 0, 'gxfer': 0, 'ttotal': 0, 'txfer': 0, 'last_update': 0, 'started': 0}
 
     statusUpdateFreq = 1.0
 
@@ -63,7 +201,14 @@ class rainshell(paramiko.client.SSHClient):
                     loglevel=LL.INFO)
 
             # initialize sftp channel
-            self.rsc = self.open_sftp()
+            self.rsc = self._open_sftp()
+
+    def _open_sftp(self):
+        """
+        open an SFTP channel with a large receive window
+        """
+        return paramiko.SFTPClient.from_transport(self.get_transport(), window_size=SFTP_WINDOW,
+                                                  max_packet_size=SFTP_MAX_PACKET)
 
     def jabber(self, jabobj):
         """
@@ -71,9 +216,10 @@ class rainshell(paramiko.client.SSHClient):
         """
         self.jbx = jabobj
 
-    def xfer(self, src, dest):
+    def _scan(self, src):
         """
-        perform recursive 'put' operation via sftp
+        enumerate local files and directories to transfer; returns a tuple of
+        (local base dir, root dir name, transfer name, dir list, file list, total size)
         """
         rps = os.path.realpath(os.path.expanduser(src))
         localbase = os.path.dirname(rps)
@@ -99,13 +245,25 @@ class rainshell(paramiko.client.SSHClient):
             flist = [ '/'+xname ]
             totsize = os.lstat(rps).st_size
 
+        return (localbase, rootdir, xname, dlist, flist, totsize)
+
+    def xfer(self, src, dest):
+        """
+        perform recursive 'put' operation via sftp, or as a tar stream
+        """
+        localbase, rootdir, xname, dlist, flist, totsize = self._scan(src)
+
         logthis(">> Xfer [%s] -> [%s]" % (src, dest), loglevel=LL.INFO)
         logthis(">> Files: %d / Dirs: %d / Size: %s" % (len(flist), len(dlist), fmtsize(totsize)), loglevel=LL.INFO)
         logthis("dlist:\n", suffix=print_r(dlist), loglevel=LL.DEBUG)
         logthis("flist:\n", suffix=print_r(flist), loglevel=LL.DEBUG)
 
+        self.timings = {}
+
         # check that we have enough free space on target device
+        tstart = time.time()
         dfree = self.df(dest)
+        self.timings['df'] = time.time() - tstart
         logthis("-- Free space on %s (%s):" % (dfree['dev'], dfree['mount']), suffix=fmtsize(dfree['free']),
                 loglevel=LL.VERBOSE)
         if dfree['free'] < totsize:
@@ -113,39 +271,497 @@ class rainshell(paramiko.client.SSHClient):
                     loglevel=LL.ERROR)
             return False
 
-        # create rootdir
-        if rootdir and not self.ifexist(dest+'/'+rootdir):
-            try:
-                self.rsc.mkdir(dest+'/'+rootdir, mode=os.lstat(localbase+'/'+rootdir).st_mode)
-            except Exception as e:
-                logthis("!! Failed to create rootdir (%s). Error:" % (localbase+'/'+rootdir), suffix=e,
-                        loglevel=LL.ERROR)
-                return False
-
-        # create directories
-        for xtd in dlist:
-            if not self.ifexist(dest+xtd):
+        # directories with many small files are sent as one tar stream, which creates
+        # the directories itself
+        usetar = self._use_tar(rootdir, flist, totsize)
+        if usetar:
+            logthis(">> Sending files as a tar stream (average size %s)" % (fmtsize(totsize // len(flist))),
+                    loglevel=LL.VERBOSE)
+        else:
+            # create rootdir
+            if rootdir and not self.ifexist(dest+'/'+rootdir):
                 try:
-                    self.rsc.mkdir(dest+xtd, mode=os.lstat(localbase+xtd).st_mode)
+                    self.rsc.mkdir(dest+'/'+rootdir, mode=os.lstat(localbase+'/'+rootdir).st_mode)
                 except Exception as e:
-                    logthis("!! Failed to create directory (%s). Error:" % (dest+rootdir), suffix=e, loglevel=LL.ERROR)
+                    logthis("!! Failed to create rootdir (%s). Error:" % (localbase+'/'+rootdir), suffix=e,
+                            loglevel=LL.ERROR)
                     return False
 
-        # set up xfer_stats
+            # create directories
+            for xtd in dlist:
+                if not self.ifexist(dest+xtd):
+                    try:
+                        self.rsc.mkdir(dest+xtd, mode=os.lstat(localbase+xtd).st_mode)
+                    except Exception as e:
+                        logthis("!! Failed to create directory (%s). Error:" % (dest+rootdir), suffix=e,
+                                loglevel=LL.ERROR)
+                        return False
+
+        # set up xfer_stats; `txfer` is the number of bytes written so far to the files in progress
         self.xfer_stats = {'xname': xname, 'files_tot': len(flist), 'files_done': 0, 'cur_file': None,
-                           'gtotal': totsize, 'gxfer': 0, 'ttotal': 0, 'txfer': 0, 'last_update': 0}
+                           'gtotal': totsize, 'gxfer': 0, 'ttotal': 0, 'txfer': 0, 'gskip': 0, 'last_update': 0,
+                           'started': time.time()}
+        self._slock = threading.Lock()
+        self._tlock = threading.Lock()
+        self._inflight = {}
+        self._partials = []
+        self._abort = None
+        self._load_manifest(dest, xname)
 
         # copy files
-        for xtf in flist:
-            logthis(">> [put] %s -> %s" % (localbase+xtf, dest+xtf), loglevel=LL.VERBOSE)
-            self.xfer_stats['cur_file'] = xtf
-            self.rsc.put(localbase+xtf, dest+xtf, callback=self._progress)
-            self.xfer_stats['files_done'] += 1
-            self.xfer_stats['gxfer'] += os.lstat(localbase+xtf).st_size
+        tstart = time.time()
+        try:
+            if usetar:
+                self._put_tar(localbase, dest, dlist, flist)
+            elif self.streams > 1 and len(flist) > 1:
+                self._put_parallel(localbase, dest, flist)
+            else:
+                for xtf in flist:
+                    self._put(self.rsc, localbase, dest, xtf)
+        except XferAborted as e:
+            e.partial = list(self._partials)
+            logthis("** Xfer aborted (%s) at %s of %s:" % (e.action, fmtsize(self.xfer_stats['gxfer'] +
+                    self.xfer_stats['txfer']), fmtsize(self.xfer_stats['gtotal'])), suffix=', '.join(e.partial),
+                    loglevel=LL.WARNING)
+            raise
+        self.timings['copy'] = time.time() - tstart
+        self.drop_manifest()
 
+        if self.xfer_stats['gskip']:
+            logthis("-- Already on remote host:", suffix=fmtsize(self.xfer_stats['gskip']), loglevel=LL.INFO)
         logthis("** Xfer complete:", suffix=xname, loglevel=LL.INFO)
         return self.xfer_stats['gxfer']
 
+    def _put(self, sftp, localbase, dest, xtf):
+        """
+        copy a single file over SFTP channel `sftp`
+        """
+        fsize = os.lstat(localbase+xtf).st_size
+        split = self.split_streams > 1 and self.split_size > 0 and fsize >= self.split_size
+
+        # pick up from what is already on the remote host
+        if self.resume:
+            roff, rdone = self._resume_state(sftp, localbase+xtf, dest+xtf, fsize, split)
+        else:
+            roff, rdone = 0, False
+        with self._slock:
+            self.xfer_stats['cur_file'] = xtf
+            self._inflight[xtf] = roff
+            self.xfer_stats['gskip'] += roff
+        try:
+            if rdone:
+                logthis("-- [skip] Already on remote host:", suffix=dest+xtf, loglevel=LL.VERBOSE)
+            elif split:
+                self._put_ranges(sftp, localbase+xtf, dest+xtf, fsize, xtf)
+            elif roff > 0:
+                logthis(">> [resume] %s -> %s from %s" % (localbase+xtf, dest+xtf, fmtsize(roff)), loglevel=LL.VERBOSE)
+                self._put_from(sftp, localbase+xtf, dest+xtf, fsize, roff, xtf)
+            else:
+                logthis(">> [put] %s -> %s" % (localbase+xtf, dest+xtf), loglevel=LL.VERBOSE)
+                self._put_from(sftp, localbase+xtf, dest+xtf, fsize, 0, xtf)
+        except XferAborted:
+            with self._slock:
+                self._partials.append(dest+xtf+PART_SUFFIX if split else dest+xtf)
+            raise
+        with self._slock:
+            del self._inflight[xtf]
+            self.xfer_stats['files_done'] += 1
+            self.xfer_stats['gxfer'] += fsize
+            self.xfer_stats['txfer'] = sum(self._inflight.values())
+
+    def _put_parallel(self, localbase, dest, flist):
+        """
+        copy files over `streams` SFTP channels at once. Each channel has its own flow
+        control window, so several channels make better use of a high-latency link than
+        one. Files are sent largest first, so that a large file doesn't end up running
+        on its own at the end
+        """
+        fqueue = sorted(flist, key=lambda x: os.lstat(localbase+x).st_size, reverse=True)
+        nstreams = min(self.streams, len(fqueue))
+        logthis(">> Sending files over %d SFTP channels" % (nstreams), loglevel=LL.VERBOSE)
+
+        def _worker(sftp):
+            while not self._abort:
+                with self._slock:
+                    if not fqueue:
+                        return
+                    xtf = fqueue.pop(0)
+                self._put(sftp, localbase, dest, xtf)
+
+        channels = [ self.rsc ]
+        try:
+            for i in range(nstreams - 1):
+                channels.append(self._open_sftp())
+            self._run_threads(_worker, [ (x,) for x in channels ], "xfer")
+        finally:
+            for tch in channels[1:]:
+                tch.close()
+
+    def _use_tar(self, rootdir, flist, totsize):
+        """
+        decide whether to send a directory as a tar stream. In 'auto' mode, this is done
+        when the average file size is under `tar_threshold`, since the transfer is then
+        dominated by per-file round trips rather than data. Single files are always sent
+        over SFTP, as is everything if the remote host has no tar
+        """
+        if not rootdir or len(flist) < 2 or self.mode == 'sftp':
+            return False
+        if self.mode != 'tar' and (self.tar_threshold <= 0 or totsize // len(flist) >= self.tar_threshold):
+            return False
+        if self._tar_ok is None:
+            self._tar_ok = bool(self.rexec('command -v tar').strip())
+            if not self._tar_ok:
+                logthis("-- tar not found on remote host; sending files over SFTP", loglevel=LL.WARNING)
+        return self._tar_ok
+
+    def _put_tar(self, localbase, dest, dlist, flist):
+        """
+        send files as a tar archive, streamed over a single channel into `tar -x` on the
+        remote host. This avoids the open/close and mkdir/stat round trips that SFTP
+        needs for every file. Progress and bandwidth limits are applied as each file is
+        read into the stream
+        """
+        # files that are already complete are left out of the archive; partial files
+        # are sent again in full
+        rsizes = self._rsizes(dest, dlist[0]) if self.resume else {}
+
+        chan = self.get_transport().open_session()
+        chan.exec_command("tar -x --no-same-owner -f - -C %s" % (shlex.quote(dest)))
+        tout = _ChannelWriter(chan)
+        tar = tarfile.open(fileobj=tout, mode='w|', bufsize=TAR_BUFSIZE, dereference=True)
+        try:
+            for xtd in dlist:
+                tar.addfile(tar.gettarinfo(localbase+xtd, arcname=xtd.lstrip('/')))
+
+            for xtf in flist:
+                tinfo = tar.gettarinfo(localbase+xtf, arcname=xtf.lstrip('/'))
+                if rsizes.get(xtf) == tinfo.size and self._tail_match(self.rsc, localbase+xtf, dest+xtf, tinfo.size):
+                    logthis("-- [skip] Already on remote host:", suffix=dest+xtf, loglevel=LL.VERBOSE)
+                    with self._slock:
+                        self.xfer_stats['gskip'] += tinfo.size
+                        self.xfer_stats['gxfer'] += tinfo.size
+                        self.xfer_stats['files_done'] += 1
+                    continue
+
+                logthis(">> [tar] %s -> %s" % (localbase+xtf, dest+xtf), loglevel=LL.DEBUG)
+                with self._slock:
+                    self.xfer_stats['cur_file'] = xtf
+                    self._inflight[xtf] = 0
+                try:
+                    with open(localbase+xtf, 'rb') as lf:
+                        tar.addfile(tinfo, _ProgressReader(lf, lambda txb: self._progress(txb, tinfo.size, xtf)))
+                except XferAborted:
+                    with self._slock:
+                        self._partials.append(dest+xtf)
+                    raise
+                with self._slock:
+                    del self._inflight[xtf]
+                    self.xfer_stats['files_done'] += 1
+                    self.xfer_stats['gxfer'] += tinfo.size
+                    self.xfer_stats['txfer'] = 0
+            tar.close()
+            chan.shutdown_write()
+        except Exception as e:
+            # closing the channel cuts the archive short, which stops the remote tar
+            tout.dropped = True
+            rerr = self._tar_error(chan)
+            chan.close()
+            if rerr and not isinstance(e, XferAborted):
+                raise IOError("Remote tar failed: %s" % (rerr))
+            raise
+
+        rstat = chan.recv_exit_status()
+        rerr = self._tar_error(chan)
+        chan.close()
+        if rstat != 0:
+            raise IOError("Remote tar exited with status %d: %s" % (rstat, rerr))
+
+    def _tar_error(self, chan):
+        """
+        returns any error output the remote tar has written so far
+        """
+        rerr = b''
+        while chan.recv_stderr_ready():
+            rerr += chan.recv_stderr(4096)
+        return rerr.decode(errors='replace').strip()
+
+    def _rsizes(self, dest, rootdir):
+        """
+        returns a dict of the sizes of the files already under `rootdir` on the remote
+        host, listed with a single `find` command rather than a stat for each file
+        """
+        rdir = dest + rootdir
+        rout = self.rexec("find %s -type f -printf '%%s %%P\\0' 2>/dev/null" % (shlex.quote(rdir)))
+        rsizes = {}
+        for tent in rout.decode(errors='surrogateescape').split('\0'):
+            tsize, _, tpath = tent.partition(' ')
+            if tpath and tsize.isdigit():
+                rsizes[rootdir+'/'+tpath] = int(tsize)
+        return rsizes
+
+    def _put_ranges(self, sftp, lpath, rpath, fsize, fkey):
+        """
+        copy a large file as `split_streams` byte ranges, each written at its offset through
+        its own SFTP channel and file handle. The file is written under a temporary name at
+        its full size, and renamed once every range is complete, so that a partly-written
+        file is never mistaken for a complete one
+        """
+        rsize = -(-fsize // self.split_streams)
+        rsize = -(-rsize // RANGE_ALIGN) * RANGE_ALIGN
+        ranges = [ (x, min(rsize, fsize - x)) for x in range(0, fsize, rsize) ]
+        rpart = rpath + PART_SUFFIX
+
+        # ranges written by a previous attempt are recorded in the manifest; only use them if
+        # the local file and the range layout are unchanged, and the partial file is still there
+        lstat = os.lstat(lpath)
+        mfile = self._mdata['files'].get(fkey)
+        if not (self.resume and mfile and mfile.get('size') == fsize and mfile.get('mtime') == lstat.st_mtime and
+                mfile.get('rsize') == rsize and self._rsize(sftp, rpart) == fsize):
+            mfile = { 'size': fsize, 'mtime': lstat.st_mtime, 'rsize': rsize, 'ranges': [ 0 ] * len(ranges) }
+            with sftp.open(rpart, 'w') as rf:
+                rf.truncate(fsize)
+        with self._slock:
+            self._mdata['files'][fkey] = mfile
+            self.xfer_stats['gskip'] += sum(mfile['ranges'])
+            self._save_manifest()
+
+        if sum(mfile['ranges']):
+            logthis(">> [resume] %s -> %s (%d ranges of %s, %s already sent)" % (lpath, rpath, len(ranges), fmtsize(rsize),
+                    fmtsize(sum(mfile['ranges']))), loglevel=LL.VERBOSE)
+        else:
+            logthis(">> [put] %s -> %s (%d ranges of %s)" % (lpath, rpath, len(ranges), fmtsize(rsize)), loglevel=LL.VERBOSE)
+
+        def _worker(rchan, ridx, roff, rlen):
+            rkey = (fkey, ridx)
+            rdone = mfile['ranges'][ridx]
+            if rdone >= rlen:
+                return
+            with self._slock:
+                self._inflight[rkey] = rdone
+
+            def _rprogress(pos):
+                nonlocal rdone
+                rdone = pos - roff
+                self._progress(rdone, rlen, rkey)
+
+            # only acknowledged writes are checkpointed (see _pump); a write that failed
+            # must not be recorded as sent, or the hole it left would be kept on resume
+            rf = rchan.open(rpart, 'r+')
+            try:
+                self._pump(lpath, rf, roff + rdone, roff + rlen, _rprogress,
+                           lambda pos: self._checkpoint(mfile, ridx, pos - roff))
+            finally:
+                try:
+                    rf.close()
+                except Exception:
+                    pass
+
+        channels = [ sftp ]
+        try:
+            for i in range(len(ranges) - 1):
+                channels.append(self._open_sftp())
+            self._run_threads(_worker, [ (channels[i], i, x[0], x[1]) for i, x in enumerate(ranges) ], "range")
+        finally:
+            for tch in channels[1:]:
+                tch.close()
+
+        # the ranges are now counted as part of the whole file
+        with self._slock:
+            for i in range(len(ranges)):
+                self._inflight.pop((fkey, i), None)
+            self._inflight[fkey] = fsize
+            self._mdata['files'].pop(fkey, None)
+            self._save_manifest()
+
+        try:
+            sftp.posix_rename(rpart, rpath)
+        except IOError:
+            # server doesn't support the posix-rename extension; rename won't replace an existing file
+            if self.ifexist(rpath):
+                sftp.remove(rpath)
+            sftp.rename(rpart, rpath)
+
+    def _put_from(self, sftp, lpath, rpath, fsize, roff, fkey):
+        """
+        copy a local file to the remote host, starting at offset `roff`; if `roff` is
+        non-zero, the rest of the file is appended to the partial remote file
+        """
+        with sftp.open(rpath, 'r+' if roff > 0 else 'w') as rf:
+            self._pump(lpath, rf, roff, fsize, lambda pos: self._progress(pos, fsize, fkey))
+
+    def _pump(self, lpath, rf, start, end, progress, checkpoint=None):
+        """
+        the write engine: copy bytes `start` to `end` of local file `lpath` to the same
+        offsets in open remote file `rf`. Blocks are read into a single preallocated buffer,
+        and sent as pipelined writes (see _SFTPWriter). `progress(pos)` is called after
+        each block. `checkpoint(pos)` is called every CHECKPOINT_INTERVAL seconds, when
+        the copy is complete, and when it is stopped by XferAborted; it is only ever
+        called once every write before `pos` has been acknowledged
+        """
+        rbuf = memoryview(bytearray(WRITE_BLOCK))
+        wr = _SFTPWriter(rf)
+        with open(lpath, 'rb', buffering=0) as lf:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(lf.fileno(), start, end - start, os.POSIX_FADV_SEQUENTIAL)
+            lf.seek(start)
+            pos = start
+            tcheck = time.time()
+            try:
+                while pos < end:
+                    rlen = lf.readinto(rbuf[:min(WRITE_BLOCK, end - pos)])
+                    if not rlen:
+                        raise IOError("Local file is shorter than expected: %s" % (lpath))
+                    wr.write(pos, rbuf[:rlen])
+                    pos += rlen
+                    progress(pos)
+                    if checkpoint and time.time() - tcheck > CHECKPOINT_INTERVAL:
+                        wr.flush()
+                        checkpoint(pos)
+                        tcheck = time.time()
+            except XferAborted:
+                # keep what was sent before a pause or preemption, if it was all written
+                if checkpoint:
+                    try:
+                        wr.flush()
+                        checkpoint(pos)
+                    except Exception:
+                        pass
+                raise
+            wr.flush()
+            if checkpoint:
+                checkpoint(pos)
+
+    def _resume_state(self, sftp, lpath, rpath, fsize, split=False):
+        """
+        check how much of a file is already on the remote host; returns a tuple of
+        (bytes already sent, complete). If `resume_check` is set, that many bytes at
+        the end of the remote data are compared against the local file, and the file
+        is sent again from the start if they differ. Files sent in ranges are never
+        partial under their final name, so only completeness is checked for them
+        """
+        rsize = self._rsize(sftp, rpath)
+        if rsize is None or rsize > fsize or (split and rsize != fsize):
+            return (0, False)
+        if rsize > 0 and not self._tail_match(sftp, lpath, rpath, rsize):
+            logthis("-- Remote data differs from local file; sending again:", suffix=rpath, loglevel=LL.WARNING)
+            return (0, False)
+        return (rsize, rsize == fsize)
+
+    def _tail_match(self, sftp, lpath, rpath, rend):
+        """
+        compare the hashes of the `resume_check` bytes before offset `rend` in the local and remote files
+        """
+        tlen = min(self.resume_check, rend)
+        if tlen <= 0:
+            return True
+        with open(lpath, 'rb') as lf:
+            lf.seek(rend - tlen)
+            lhash = hashlib.md5(lf.read(tlen)).hexdigest()
+        with sftp.open(rpath, 'r') as rf:
+            rf.seek(rend - tlen)
+            rhash = hashlib.md5(rf.read(tlen)).hexdigest()
+        return lhash == rhash
+
+    def _rsize(self, sftp, rpath):
+        """
+        returns the size of a remote file, or None if it doesn't exist
+        """
+        try:
+            return sftp.stat(rpath).st_size
+        except IOError:
+            return None
+
+    def _load_manifest(self, dest, xname):
+        """
+        load the progress manifest for this transfer; it is discarded if it was
+        written for a different destination
+        """
+        self._mdata = { 'dest': dest, 'xname': xname, 'files': {} }
+        if not (self.manifest and self.resume):
+            return
+        try:
+            with open(self.manifest, 'r') as f:
+                mdata = json.load(f)
+            if mdata.get('dest') == dest and mdata.get('xname') == xname:
+                self._mdata = mdata
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logexc(e, "Failed to read transfer manifest; ignoring it")
+
+    def _save_manifest(self):
+        """
+        write the progress manifest; must be called with the stats lock held
+        """
+        if not self.manifest:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.manifest)):
+                os.makedirs(os.path.dirname(self.manifest), 0o700)
+            with open(self.manifest + ".tmp", 'w') as f:
+                json.dump(self._mdata, f)
+            os.rename(self.manifest + ".tmp", self.manifest)
+        except Exception as e:
+            logexc(e, "Failed to write transfer manifest")
+
+    def _checkpoint(self, mfile, ridx, rdone):
+        """
+        record that the first `rdone` bytes of range `ridx` have been written
+        """
+        with self._slock:
+            mfile['ranges'][ridx] = rdone
+            self._save_manifest()
+
+    def drop_manifest(self):
+        """
+        remove the progress manifest, once the transfer is complete or cancelled
+        """
+        if self.manifest:
+            try:
+                os.unlink(self.manifest)
+            except FileNotFoundError:
+                pass
+
+    def _run_threads(self, target, arglist, name):
+        """
+        run `target(*args)` in a new thread for each entry in `arglist`, and wait for them
+        all to finish. If any of them fails, the others are stopped at their next chunk,
+        and the first error is raised
+        """
+        errors = []
+        def _wrapper(*args):
+            try:
+                target(*args)
+            except Exception as e:
+                with self._slock:
+                    errors.append(e)
+                    if not self._abort:
+                        self._abort = e.action if isinstance(e, XferAborted) else 'error'
+
+        threads = [ threading.Thread(target=_wrapper, args=x, name="%s-%d" % (name, i)) for i, x in enumerate(arglist) ]
+        for tt in threads:
+            tt.start()
+        for tt in threads:
+            tt.join()
+
+        if errors:
+            raise errors[0]
+
+    def verify(self, src, dest):
+        """
+        check that all files under `src` exist under `dest` on the remote host with
+        the same size; returns a list of files that are missing or differ
+        """
+        localbase, rootdir, xname, dlist, flist, totsize = self._scan(src)
+        badfiles = []
+        for xtf in flist:
+            try:
+                if self.rsc.stat(dest+xtf).st_size != os.lstat(localbase+xtf).st_size:
+                    badfiles.append(xtf)
+            except IOError:
+                badfiles.append(xtf)
+        return badfiles
+
     def df(self, path):
         """
         get free diskspace for a given input path
@@ -163,22 +779,43 @@ class rainshell(paramiko.client.SSHClient):
         sout = so.read()
         return sout
 
-    def _progress(self, txb, totb):
+    def _progress(self, txb, totb, fkey=None):
         """
-        file xfer progress callback
+        file xfer progress callback; `fkey` identifies the file, when several are being sent at once
         """
+        # another stream has been stopped; stop this one too
+        if self._abort:
+            raise XferAborted(self._abort)
+
         nowtime = time.time()
-        self.xfer_stats['txfer'] = txb
-        self.xfer_stats['ttotal'] = totb
+        with self._slock:
+            tdelta = max(0, txb - self._inflight.get(fkey, 0))
+            self._inflight[fkey] = txb
+            self.xfer_stats['txfer'] = sum(self._inflight.values())
+            self.xfer_stats['ttotal'] = totb
+            tupdate = (nowtime - self.xfer_stats['last_update']) > self.statusUpdateFreq
+            if tupdate:
+                self.xfer_stats['last_update'] = nowtime
+        # all streams share one byte budget
+        if self.throttle:
+            with self._tlock:
+                self.throttle.consume(tdelta)
         # if statusUpdateFreq has elapsed, then update jabber status
-        if (nowtime - self.xfer_stats['last_update']) > self.statusUpdateFreq:
+        if tupdate:
             # update jabber status
             dltot = self.xfer_stats['gxfer'] + self.xfer_stats['txfer']
             percento = float(dltot) / float(self.xfer_stats['gtotal']) * 100.0
             statline = "Downloading [%0.01f%% -- %s of %s]: %s" % \
                        (percento, fmtsize(dltot), fmtsize(self.xfer_stats['gtotal']), self.xfer_stats['xname'])
             jabber.send('set_status', {'show': "xa", 'status': statline})
-            self.xfer_stats['last_update'] = nowtime
+            if self.progress_hook:
+                self.progress_hook(self.xfer_stats)
+            # stop between chunks if the job has been cancelled, paused or preempted
+            if self.control_hook:
+                xaction = self.control_hook()
+                if xaction:
+                    self._abort = xaction
+                    raise XferAborted(xaction)
 
     def ifexist(self, rpath):
         """
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.supervisor
+Rainwatch > Child process supervisor
+
+Forks and supervises the worker processes of the master (queue runners, jabber client);
+crashed children are reaped via SIGCHLD and respawned with exponential backoff
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import os
+import sys
+import stat
+import time
+import select
+import signal
+import socket
+import ctypes
+import ctypes.util
+import threading
+import contextlib
+
+from rwatch.logthis import *
+
+
+# prctl() option to set the signal sent to a child when its parent dies (Linux only)
+PR_SET_PDEATHSIG = 1
+
+# children that run for at least this long (in seconds) are considered stable,
+# and their restart backoff is reset
+STABLE_TIME = 60.0
+
+conf = None
+
+# Supervised children, by name; and names by PID
+children = {}
+pids = {}
+
+# Master PID, and parent-death pipe; the master holds the write end open for its lifetime,
+# so children see EOF on the read end as soon as the master exits
+dadpid = None
+deathpipe = None
+
+# Set by the SIGCHLD handler to wake the supervisor thread; `lock` is held while forking
+chld_event = None
+lock = None
+
+# The supervisor thread; all children are forked from it (see _child_init)
+sthread = None
+
+def setup(xconfig):
+    """
+    set up supervision; must be called in the master before spawning any children
+    """
+    global conf, dadpid, deathpipe, chld_event, lock, sthread
+    conf = xconfig
+    dadpid = os.getpid()
+    deathpipe = os.pipe()
+    chld_event = threading.Event()
+    lock = threading.RLock()
+
+    signal.signal(signal.SIGCHLD, _sigchld)
+
+    sthread = threading.Thread(target=supervise, name="supervisor", daemon=True)
+    sthread.start()
+    logthis("Supervisor started", loglevel=LL.DEBUG)
+
+def spawn(name, target, *args):
+    """
+    fork a supervised child named `name`, which runs target(*args)
+    the child is respawned if it exits, unless it has been retired.
+    The fork is done by the supervisor thread; this waits for it, and
+    returns the child PID (or None if the fork failed)
+    """
+    global children, lock, chld_event, sthread
+    child = {'name': name, 'target': target, 'args': args, 'pid': None, 'alive': False,
+             'started': None, 'restarts': 0, 'failures': 0, 'last_exit': None,
+             'last_exit_time': None, 'respawn_at': None, 'retired': False,
+             'pending': True, 'forked': threading.Event()}
+    with lock:
+        children[name] = child
+    if threading.current_thread() is sthread:
+        return _spawn_pending(child)
+    chld_event.set()
+    child['forked'].wait()
+    return child['pid']
+
+def _spawn_pending(child):
+    """
+    fork a child requested by spawn(); called from the supervisor thread
+    """
+    child['pending'] = False
+    pid = _fork(child)
+    child['forked'].set()
+    return pid
+
+@contextlib.contextmanager
+def nofork():
+    """
+    context manager that holds off forking new children; wrap sections that hold a
+    file descriptor which must not be inherited by a child, such as one with a
+    flock() on it. Does nothing if supervision has not been set up (eg. in the hook)
+    """
+    global lock
+    if lock is None:
+        yield
+        return
+    with lock:
+        yield
+
+def retire(name):
+    """
+    mark a child as retired; it will not be respawned once it exits
+    """
+    global children, lock
+    with lock:
+        if name in children:
+            children[name]['retired'] = True
+
+def _fork(child):
+    """
+    fork a child process from its supervisor entry; returns the child PID
+    """
+    global pids, dadpid, deathpipe
+
+    try:
+        pid = os.fork()
+    except OSError as e:
+        logthis("os.fork() failed:", prefix=child['name'], suffix=e, loglevel=LL.ERROR)
+        child['respawn_at'] = time.time() + backoff(child)
+        return None
+
+    if pid:
+        # parent
+        child['pid'] = pid
+        child['alive'] = True
+        child['started'] = time.time()
+        child['respawn_at'] = None
+        pids[pid] = child['name']
+        return pid
+
+    # child; always exit here rather than unwinding back into the supervisor thread
+    rcode = 0
+    try:
+        _child_init()
+        child['target'](*child['args'])
+    except SystemExit as e:
+        if isinstance(e.code, int): rcode = e.code
+        elif e.code is not None: rcode = 1
+    except BaseException as e:
+        logexc(e, "Unhandled exception in child process", prefix=child['name'])
+        rcode = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(rcode)
+
+def _child_init():
+    """
+    set up parent-death notification in a newly-forked child.
+    PR_SET_PDEATHSIG is delivered when the *thread* that forked the child exits,
+    not when the master process does; so only the supervisor thread, which lives
+    as long as the master, may fork children. Use spawn(), never os.fork().
+    The master spawns its initial children before starting any other threads;
+    children respawned later only inherit the state of the forking thread, so
+    they must not use locks or connections that belong to the master
+    """
+    global deathpipe, dadpid
+
+    # restore default SIGCHLD handling; only the master supervises
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    # close the write end of the death pipe; only the master may hold it open
+    os.close(deathpipe[1])
+
+    # don't hold the master's listening sockets (API, hook socket) open
+    _close_listeners()
+
+    # ask the kernel to send SIGTERM when the master dies (Linux only)
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0) != 0:
+            logthis("prctl(PR_SET_PDEATHSIG) failed; errno =", suffix=ctypes.get_errno(), loglevel=LL.DEBUG)
+    except (OSError, AttributeError, TypeError) as e:
+        logthis("prctl() not available; relying on death pipe", loglevel=LL.DEBUG)
+
+    # the master may have died before prctl() took effect
+    if os.getppid() != dadpid:
+        logthis("Master terminated during startup", loglevel=LL.WARNING)
+        os._exit(0)
+
+def _close_listeners():
+    """
+    close any listening sockets inherited from the master (Linux only)
+    """
+    try:
+        fdlist = [ int(x) for x in os.listdir('/proc/self/fd') ]
+    except OSError:
+        return
+
+    for tfd in fdlist:
+        try:
+            if not stat.S_ISSOCK(os.fstat(tfd).st_mode):
+                continue
+            tsock = socket.socket(fileno=tfd)
+        except OSError:
+            continue
+        try:
+            if tsock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+                tsock.close()
+                continue
+        except OSError:
+            pass
+        tsock.detach()
+
+def master_alive():
+    """
+    returns False once the master process has terminated; the read end
+    of the death pipe becomes readable (EOF) when the master exits
+    """
+    global deathpipe
+    try:
+        rlist, _, _ = select.select([deathpipe[0]], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not rlist
+
+def wait_master(timeout):
+    """
+    block for up to `timeout` seconds, or until the master terminates;
+    returns False if the master has terminated
+    """
+    global deathpipe
+    try:
+        rlist, _, _ = select.select([deathpipe[0]], [], [], timeout)
+    except (OSError, ValueError):
+        return False
+    return not rlist
+
+def backoff(child):
+    """
+    returns the delay before respawning a child, based on its consecutive failures
+    """
+    global conf
+    return min(float(conf.srv['restart_delay']) * (2 ** max(0, child['failures'] - 1)),
+               float(conf.srv['restart_max_delay']))
+
+def _sigchld(signum, frame):
+    """
+    SIGCHLD handler; wake the supervisor thread to reap and respawn children
+    """
+    global chld_event
+    chld_event.set()
+
+def reap():
+    """
+    reap any children that have exited, and schedule them to be respawned
+    """
+    global children, pids, lock
+
+    with lock:
+        for pid in list(pids.keys()):
+            try:
+                wpid, wstatus = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                wpid, wstatus = pid, 0
+            if not wpid:
+                continue
+
+            child = children[pids.pop(pid)]
+            child['alive'] = False
+            child['last_exit_time'] = time.time()
+            if os.WIFSIGNALED(wstatus):
+                child['last_exit'] = -os.WTERMSIG(wstatus)
+            else:
+                child['last_exit'] = os.WEXITSTATUS(wstatus)
+
+            if child['retired']:
+                logthis("Retired child exited. pid =", prefix=child['name'], suffix=pid, loglevel=LL.VERBOSE)
+                continue
+
+            # reset backoff for children that were running stably
+            if (child['last_exit_time'] - child['started']) >= STABLE_TIME:
+                child['failures'] = 0
+            child['failures'] += 1
+            rdelay = backoff(child)
+            child['respawn_at'] = time.time() + rdelay
+            logthis("!! Child exited (status %s); respawning in %0.1f seconds. pid =" % (child['last_exit'], rdelay),
+                    prefix=child['name'], suffix=pid, loglevel=LL.ERROR)
+
+def supervise():
+    """
+    supervisor thread; forks new children, reaps exited children, and respawns them
+    when their backoff has elapsed
+    """
+    global children, chld_event, lock
+
+    while True:
+        chld_event.wait(1.0)
+        chld_event.clear()
+        reap()
+
+        with lock:
+            for child in list(children.values()):
+                # new children requested by spawn()
+                if child['pending']:
+                    pid = _spawn_pending(child)
+                    if pid:
+                        logthis("Spawned child. pid =", prefix=child['name'], suffix=pid, loglevel=LL.DEBUG)
+                    continue
+                if not child['alive'] and not child['retired'] and child['respawn_at'] \
+                   and time.time() >= child['respawn_at']:
+                    child['restarts'] += 1
+                    pid = _fork(child)
+                    if pid:
+                        logthis("** Respawned child. pid =", prefix=child['name'], suffix=pid, loglevel=LL.WARNING)
+
+def status():
+    """
+    returns health and restart counts for all supervised children
+    """
+    global children, lock
+    with lock:
+        return { x['name']: {'pid': x['pid'], 'alive': x['alive'], 'started': x['started'], 'restarts': x['restarts'],
+                             'last_exit': x['last_exit'], 'last_exit_time': x['last_exit_time'],
+                             'respawn_at': x['respawn_at'], 'retired': x['retired']}
+                 for x in children.values() }
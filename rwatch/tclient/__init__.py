@@ -17,13 +17,13 @@ https://ycnrg.org/
 import os
 import sys
 import re
+import importlib
 
 from rwatch.logthis import *
 from rwatch.util import *
 
-from rwatch.tclient import deluge, rtorrent
-
-tc_lut = { 'deluge': deluge.delcon, 'rtorrent': rtorrent.rtcon }
+# client name -> (module, class); only the configured client's module is imported
+tc_lut = { 'deluge': ('deluge', 'delcon'), 'rtorrent': ('rtorrent', 'rtcon') }
 
 attr_tinfo = [
                 'hash', 'name', 'path', 'base_path', 'time_added', 'comment', 'message', 'tracker_status',
@@ -57,7 +57,8 @@ class TorrentClient(object):
 
         # spawn torrent client
         self.client_type = client
-        self.tor = tc_lut[client].fromXConfig(xconfig)
+        tmod, tclass = tc_lut[client]
+        self.tor = getattr(importlib.import_module('rwatch.tclient.' + tmod), tclass).fromXConfig(xconfig)
         self.connected = self.tor.connected
 
     def __getattr__(self, aname):
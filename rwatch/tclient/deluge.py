@@ -16,10 +16,14 @@ https://ycnrg.org/
 
 import os
 import re
+import zlib
+import socket
+import struct
 from collections import defaultdict
 
 from deluge_client import DelugeRPCClient
-from deluge_client.client import ConnectionLostException, CallTimeoutException
+from deluge_client.client import ConnectionLostException, CallTimeoutException, RPC_RESPONSE, RPC_ERROR, RPC_EVENT
+from deluge_client.rencode import loads
 
 from rwatch.logthis import *
 
@@ -98,6 +102,99 @@ class DelugeRPCUnicode(DelugeRPCClient):
         return super(DelugeRPCUnicode, self).call(method, *args, **kwargs)
 
 
+class DelugeEventClient(DelugeRPCUnicode):
+    """
+    Deluge RPC client for receiving events. DelugeRPCClient discards event
+    messages, and may split a message that arrives in the same read as another,
+    so this client does its own message framing. Once listen() is called, it
+    should only be used for events
+    """
+    def __init__(self, *args, **kwargs):
+        super(DelugeEventClient, self).__init__(*args, **kwargs)
+        self._rbuf = b''
+        self._dobj = None
+        self._dout = b''
+
+    def _fill(self):
+        """read more data from the socket into the buffer"""
+        rdata = self._socket.recv(65536)
+        if not rdata:
+            raise ConnectionLostException()
+        self._rbuf += rdata
+
+    def read_message(self):
+        """
+        read the next message; returns a list of [message type, ...]. Partial messages
+        are kept if the read times out, so it can be retried
+        """
+        if self.deluge_version == 2:
+            # Deluge 2.x: 5-byte header (protocol version and payload length), then the payload
+            while len(self._rbuf) < 5:
+                self._fill()
+            if self.deluge_protocol_version is None:
+                mlen = struct.unpack('!i', self._rbuf[1:5])[0]
+            else:
+                mlen = struct.unpack('!I', self._rbuf[1:5])[0]
+            while len(self._rbuf) < 5 + mlen:
+                self._fill()
+            mraw = zlib.decompress(self._rbuf[5:5 + mlen])
+            self._rbuf = self._rbuf[5 + mlen:]
+        else:
+            # Deluge 1.x: messages are not framed; each is a complete zlib stream
+            if self._dobj is None:
+                self._dobj = zlib.decompressobj()
+                self._dout = b''
+            while not self._dobj.eof:
+                if not self._rbuf:
+                    self._fill()
+                tin, self._rbuf = self._rbuf, b''
+                self._dout += self._dobj.decompress(tin)
+            mraw = self._dout
+            self._rbuf = self._dobj.unused_data + self._rbuf
+            self._dobj = None
+
+        return list(loads(mraw, decode_utf8=self.decode_utf8))
+
+    def subscribe(self, events):
+        """register interest in `events` (list of event names)"""
+        self._send_call(self.deluge_version, self.deluge_protocol_version, 'daemon.set_event_interest', events)
+        while True:
+            tmsg = self.read_message()
+            if tmsg[0] == RPC_RESPONSE:
+                return tmsg[2]
+            elif tmsg[0] == RPC_ERROR:
+                raise Exception("daemon.set_event_interest failed: %s" % (tmsg[2:],))
+
+    def listen(self, events, callback, idle=60, ready=None):
+        """
+        subscribe to `events`, and call `callback(event, args)` as each is received; `ready()`
+        is called once subscribed. If nothing is received for `idle` seconds, the connection is
+        checked with a ping; it is treated as lost if the ping isn't answered in the same time.
+        Blocks until the connection is lost
+        """
+        self.subscribe(events)
+        if ready:
+            ready()
+
+        self._socket.settimeout(idle)
+        pinged = False
+        while True:
+            try:
+                tmsg = self.read_message()
+            except socket.timeout:
+                if pinged:
+                    raise ConnectionLostException()
+                self._send_call(self.deluge_version, self.deluge_protocol_version, 'daemon.info')
+                pinged = True
+                continue
+
+            pinged = False
+            if tmsg[0] == RPC_EVENT:
+                callback(tmsg[1], tmsg[2])
+            elif tmsg[0] == RPC_ERROR:
+                logthis("Error from Deluge on event connection:", suffix=tmsg[2:], loglevel=LL.WARNING)
+
+
 class delcon:
     """class for handling Deluge RPC comms"""
     xcon = None
@@ -147,6 +244,22 @@ class delcon:
                     logexc(e, "Deluge re-connection attempt failed")
         return self.connected
 
+    def watchEvents(self, events, callback, idle=60, ready=None):
+        """
+        call `callback(event, args)` for each of `events` emitted by deluged; blocks until the
+        connection is lost. A separate connection is used, so that events are not mixed in with
+        responses to calls on this one
+        """
+        econ = DelugeEventClient(self.xcon.host, self.xcon.port, self.xcon.username, self.xcon.password, decode_utf8=True)
+        try:
+            econ.connect()
+            econ.listen(events, callback, idle=idle, ready=ready)
+        finally:
+            try:
+                econ.disconnect()
+            except Exception:
+                pass
+
     def getTorrent(self, torid):
         """get info on a particular torrent"""
         self.checkConnection()
@@ -19,11 +19,12 @@ import re
 import subprocess
 import socket
 
-import arrow
-
 from rwatch import *
 from rwatch.logthis import *
 
+# Cached result of git_info_raw()
+gitinfo = None
+
 
 class XConfig(object):
     """
@@ -46,6 +47,9 @@ class XConfig(object):
     def __getitem__(self, aname):
         return self.__getattr__(aname)
 
+    def keys(self):
+        return self.__data.keys()
+
     def __str__(self):
         return print_r(self.__data)
 
@@ -156,16 +160,25 @@ def git_info():
 
 def git_info_raw():
     """
-    retrieve git info from local log (does not invoke git binary)
+    retrieve git info from local log (does not invoke git binary); the result is
+    cached after the first call
     """
+    global gitinfo
+    if gitinfo is not None:
+        return gitinfo
+
     rvx = { 'ref': None, 'sref': None, 'date': None }
 
     rpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
     if os.path.exists(rpath + '/.git'):
         try:
-            with open(rpath + '/.git/logs/HEAD', 'r') as f:
-                last = f.readlines()[-1]
+            import arrow
+            # only the last entry is needed, so read the tail of the log rather than the whole file
+            with open(rpath + '/.git/logs/HEAD', 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 4096))
+                last = f.read().decode('utf-8', 'replace').strip().splitlines()[-1]
             last_info, last_msg = last.strip().split('\t', 1)
             infos = last_info.split()
             chgtype, msg = last_msg.split(':', 1)
@@ -178,6 +191,7 @@ def git_info_raw():
                   }
         except:
             pass
+    gitinfo = rvx
     return rvx
 
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3.5
+# coding=utf-8
+# vim: set ts=4 sw=4 expandtab syntax=python:
+"""
+
+rwatch.watch
+Rainwatch > Completion detection in the daemon
+
+Completed torrents are detected by the daemon itself: Deluge's TorrentFinishedEvent
+is received over a dedicated RPC connection, and a periodic reconciliation poll of
+the torrent client catches completions that were missed, eg. while the daemon was
+down or reconnecting to Deluge
+
+Copyright (c) 2016 J. Hipps / Neo-Retro Group
+https://ycnrg.org/
+
+@author     Jacob Hipps <jacob@ycnrg.org>
+@repo       https://git.ycnrg.org/projects/YRW/repos/rainwatch
+
+"""
+
+import time
+import threading
+
+from rwatch.logthis import *
+from rwatch import queue
+
+
+# Deluge event emitted when a torrent finishes downloading
+FINISHED_EVENT = "TorrentFinishedEvent"
+
+# Seconds without any message on the event connection before it is pinged
+EVENT_IDLE = 60
+
+# Serializes the check-and-mark of completed torrents between the event and poll threads
+lock = threading.Lock()
+
+# Set to run a reconciliation poll immediately, eg. after the event connection is re-established
+wakeup = threading.Event()
+
+
+def seenkey(xconfig):
+    """
+    returns the name of the set of completed torrents that have already been queued
+    (zset of torrent hash -> time seen); node-scoped in cluster mode
+    """
+    return queue.scope("completed", xconfig)
+
+
+def start(xconfig, xredis, xdlx, handler):
+    """
+    start the event listener and reconciliation threads. `handler(thash, size)` is
+    called for each newly completed torrent, and should raise an exception if it
+    could not be queued; `size` is None if it is not known
+    """
+    if xconfig.core['tclient'].lower() == 'deluge' and int(xconfig.deluge['events']):
+        lthread = threading.Thread(target=listener, args=(xconfig, xredis, xdlx, handler), name="events", daemon=True)
+        lthread.start()
+        logthis("Listening for completion events from Deluge", loglevel=LL.VERBOSE)
+
+    if float(xconfig.core['reconcile_interval']) > 0:
+        rthread = threading.Thread(target=reconciler, args=(xconfig, xredis, xdlx, handler), name="reconcile", daemon=True)
+        rthread.start()
+        logthis("Polling torrent client for completions every %ss" % (xconfig.core['reconcile_interval']), loglevel=LL.VERBOSE)
+
+
+def listener(xconfig, xredis, xdlx, handler):
+    """
+    event listener thread; reconnects with backoff if the connection to Deluge is lost
+    """
+    rdelay = 1
+
+    def _on_ready():
+        nonlocal rdelay
+        rdelay = 1
+        logthis("Subscribed to Deluge events:", suffix=FINISHED_EVENT, loglevel=LL.VERBOSE)
+        # catch anything that finished while we weren't subscribed
+        wakeup.set()
+
+    def _on_event(ename, eargs):
+        if ename != FINISHED_EVENT or not eargs:
+            return
+        try:
+            completed(xredis, xconfig, eargs[0], handler, source="event")
+        except Exception as e:
+            logexc(e, "!! Failed to queue completed torrent %s; it will be retried by the next poll" % (eargs[0]))
+
+    while True:
+        try:
+            xdlx.watchEvents([FINISHED_EVENT], _on_event, idle=EVENT_IDLE, ready=_on_ready)
+        except Exception as e:
+            logexc(e, "!! Lost Deluge event connection; reconnecting in %ds" % (rdelay))
+        time.sleep(rdelay)
+        rdelay = min(rdelay * 2, 60)
+
+
+def reconciler(xconfig, xredis, xdlx, handler):
+    """
+    reconciliation poll thread
+    """
+    while True:
+        try:
+            reconcile(xredis, xconfig, xdlx, handler)
+        except Exception as e:
+            logexc(e, "!! Failed to poll torrent client for completions")
+        wakeup.wait(float(xconfig.core['reconcile_interval']))
+        wakeup.clear()
+
+
+def completed(xredis, xconfig, thash, handler, size=None, source="event"):
+    """
+    queue completed torrent `thash`, unless it has already been queued; returns True
+    if it was queued
+    """
+    with lock:
+        if xredis.zscore(seenkey(xconfig), thash) is not None:
+            return False
+        handler(thash, size)
+        xredis.zadd(seenkey(xconfig), thash, time.time())
+    logthis(">> Queued completed torrent (%s):" % (source), suffix=thash, loglevel=LL.INFO)
+    return True
+
+
+def mark(xredis, xconfig, thash):
+    """
+    record that `thash` has been queued by other means (eg. the completion hook),
+    so that it is not queued again by the poll
+    """
+    xredis.zadd(seenkey(xconfig), thash, time.time())
+
+
+def reconcile(xredis, xconfig, xdlx, handler):
+    """
+    queue any finished torrents that have not been queued yet; returns the number queued.
+    On the first poll, the torrents that are already finished are recorded without being
+    queued, so that enabling completion detection doesn't transfer the whole client again
+    """
+    tlist = xdlx.getTorrentList()
+    if tlist is False:
+        return 0
+    finished = { k: v for k, v in tlist.items() if float(v.get('progress') or 0) >= 100.0 }
+
+    skey = seenkey(xconfig)
+    if not xredis.exists(skey + "_init"):
+        with lock:
+            for thash in finished:
+                xredis.zadd(skey, thash, time.time())
+            xredis.set(skey + "_init", time.time())
+        logthis("Recorded %d already-finished torrents; they will not be queued" % (len(finished)), loglevel=LL.INFO)
+        return 0
+
+    qcount = 0
+    for thash, tinfo in finished.items():
+        try:
+            if completed(xredis, xconfig, thash, handler, size=tinfo.get('total_size'), source="poll"):
+                qcount += 1
+        except Exception as e:
+            logexc(e, "!! Failed to queue completed torrent %s" % (thash))
+
+    # forget torrents that have been removed from the client
+    for thash in set(xredis.zrange(skey, 0, -1)) - set(tlist.keys()):
+        xredis.zrem(skey, thash)
+
+    return qcount
@@ -15,7 +15,7 @@ setup(
     packages = find_packages(),
     scripts = [],
 
-    install_requires = ['docutils', 'setproctitle', 'pymongo', 'redis', 'pyzmq', 'pymediainfo', 'enzyme',
+    install_requires = ['docutils', 'setproctitle', 'pymongo', 'redis>=4.0', 'pyzmq', 'pymediainfo', 'enzyme',
                         'deluge-client', 'paramiko', 'flask>=0.10.1', 'requests>=2.2.1',
                         'arrow', 'sleekxmpp>=1.4.0', 'dnspython', 'Pillow>=3.4.0'],
 
@@ -24,7 +24,7 @@ setup(
     },
 
     entry_points = {
-        'console_scripts': [ 'rainwatch = rwatch.cli:_main' ]
+        'console_scripts': [ 'rainwatch = rwatch.cli:_main', 'rainwatch-hook = rwatch.hook:_main' ]
     }
 
     # could also include long_description, download_url, classifiers, etc.